@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from collections import OrderedDict
+from Index import Index
+from GraphemeBasedMapper import Grapheme_Based_Mapper
+from MorphDecomposer import Morph_Decomposer
+from ScoreNormalizer import Normalize_score
+from SystemCombiner import System_Combiner
+from XMLListIO import XML_list_reader
+
+
+BENCHMARK_FILE_VERSION = 1
+
+DEFAULT_BENCHMARK_CONFIG = OrderedDict([("hours",1.0),("vocabulary_size",20000),("n_files",10),("silence_rate",0.1),
+        ("n_keywords",500),("oov_rate",0.1),("multi_word_rate",0.3),("seed",0)])
+
+# syllables and affixes of the synthetic words (Swahili-like: open syllables, noun class and verb prefixes)
+CONSONANTS = ["b","ch","d","f","g","h","j","k","l","m","n","ng","ny","p","r","s","sh","t","v","w","y","z"]
+VOWELS = ["a","e","i","o","u"]
+NOUN_PREFIXES = ["m","wa","mi","ki","vi","ji","ma","u","ku","pa"]
+SUBJECT_PREFIXES = ["ni","u","a","tu","m","wa"]
+TENSE_PREFIXES = ["na","li","ta","me","ki"]
+
+
+def generate_root(rng):
+        return "".join(CONSONANTS[rng.integers(len(CONSONANTS))] + VOWELS[rng.integers(len(VOWELS))] for syllable in range(rng.integers(1,4)))
+
+def generate_morphs(rng):
+        # morphological decomposition of a new synthetic word: a bare root, a noun (class prefix + root)
+        # or a verb (subject prefix + tense prefix + root)
+        kind = rng.random()
+        if kind < 0.2:
+                return [generate_root(rng)]
+        elif kind < 0.6:
+                return [NOUN_PREFIXES[rng.integers(len(NOUN_PREFIXES))],generate_root(rng)]
+        return [SUBJECT_PREFIXES[rng.integers(len(SUBJECT_PREFIXES))],TENSE_PREFIXES[rng.integers(len(TENSE_PREFIXES))],generate_root(rng)]
+
+def generate_lexicon(n_words,rng):
+        # dictionary mapping n_words distinct synthetic words to their morphological decomposition
+        lexicon = OrderedDict()
+        while len(lexicon) < n_words:
+                morphs = generate_morphs(rng)
+                lexicon.setdefault("".join(morphs),morphs)
+        return lexicon
+
+def generate_OOV_words(n_words,lexicon,rng):
+        OOV_words = []
+        while len(OOV_words) < n_words:
+                word = "".join(generate_morphs(rng))
+                if word not in lexicon:
+                        OOV_words.append(word)
+        return OOV_words
+
+def write_dct(path_to_dictionary_document,lexicon):
+        # .dct file: one word per line, followed by its morphological decomposition
+        with open(path_to_dictionary_document,"w") as f:
+                for word, morphs in lexicon.items():
+                        f.write(word + " " + " ".join(morphs) + "\n")
+
+def write_grapheme_confusion_counts(path_to_grapheme_confusion_file,lexicon,rng):
+        """
+        Writes a .map file of grapheme confusion counts ("reference observed count" lines, "sil" standing for
+        deletions and insertions) for the graphemes of the lexicon: a grapheme is mostly recognized as itself, and otherwise
+        confused with a few graphemes of the same kind (vowel or consonant) or deleted
+        """
+        graphemes = sorted(set("".join(lexicon)))
+        vowels = [grapheme for grapheme in graphemes if grapheme in VOWELS]
+        consonants = [grapheme for grapheme in graphemes if grapheme not in VOWELS]
+        with open(path_to_grapheme_confusion_file,"w") as f:
+                for grapheme in graphemes:
+                        f.write("%s %s %d\n" % (grapheme,grapheme,rng.integers(2000,10000)))
+                        similar_graphemes = [other for other in (vowels if grapheme in VOWELS else consonants) if other != grapheme]
+                        for other in rng.choice(similar_graphemes,size=min(4,len(similar_graphemes)),replace=False):
+                                f.write("%s %s %d\n" % (grapheme,other,rng.integers(10,500)))
+                        f.write("%s sil %d\n" % (grapheme,rng.integers(10,200)))
+                for grapheme in graphemes:
+                        f.write("sil %s %d\n" % (grapheme,rng.integers(1,100)))
+
+def zipf_probabilities(n_words):
+        probabilities = 1.0/np.arange(1,n_words+1)
+        return probabilities/probabilities.sum()
+
+def write_CTM(path_to_CTM_document,lexicon,hours,n_files,silence_rate,rng):
+        """
+        Writes a synthetic 1-best CTM file of about hours hours of speech, split in n_files files of equal duration
+        Words are drawn from the lexicon with Zipfian frequencies, their duration grows with their length, a fraction
+        silence_rate of them is followed by a silence of more than 0.5 second, and their posteriors are skewed towards 1
+        Returns the number of lines written
+        """
+        words = list(lexicon)
+        probabilities = zipf_probabilities(len(words))
+        file_duration = hours*3600.0/n_files
+        n_lines = 0
+        with open(path_to_CTM_document,"w") as f:
+                for file_index in range(n_files):
+                        file_name = "BABEL_OP2_202_%05d_20140101_000000_inLine" % file_index
+                        # enough words for the file (the average duration of a word and of the gap after it is above 0.3 second)
+                        n_words = int(file_duration/0.3) + 1
+                        word_indices = rng.choice(len(words),size=n_words,p=probabilities)
+                        gaps = np.where(rng.random(n_words) < silence_rate,rng.uniform(0.6,3.0,n_words),rng.uniform(0.0,0.1,n_words))
+                        posteriors = rng.beta(5.0,1.0,n_words)
+                        tbeg = 0.0
+                        for word_index, gap, posterior in zip(word_indices,gaps,posteriors):
+                                word = words[word_index]
+                                tdur = round(0.05*len(word) + 0.1,2)
+                                if tbeg + tdur > file_duration:
+                                        break
+                                f.write("%s 1 %.2f %.2f %s %.6f\n" % (file_name,tbeg,tdur,word,posterior))
+                                n_lines += 1
+                                tbeg = round(tbeg + tdur + gap,2)
+        return n_lines
+
+def write_kwlist(path_to_XML_query_list,lexicon,n_keywords,oov_rate,multi_word_rate,rng):
+        """
+        Writes a kwlist XML file of n_keywords queries: a fraction multi_word_rate of them has 2 or 3 words (the others one),
+        and a fraction oov_rate of them contains an OOV word (absent from the lexicon)
+        The IV words are drawn with the same Zipfian frequencies as in write_CTM, among the 5000 most frequent ones
+        """
+        words = list(lexicon)[:5000]
+        probabilities = zipf_probabilities(len(words))
+        with open(path_to_XML_query_list,"w") as f:
+                f.write('<kwlist ecf_filename="IARPA-babel202b-v1.0d_conv-dev.ecf.xml" language="swahili" encoding="UTF-8" compareNormalize="" version="1">\n')
+                for keyword_index in range(n_keywords):
+                        n_words = int(rng.integers(2,4)) if rng.random() < multi_word_rate else 1
+                        query_words = [words[word_index] for word_index in rng.choice(len(words),size=n_words,p=probabilities)]
+                        if rng.random() < oov_rate:
+                                query_words[rng.integers(n_words)] = generate_OOV_words(1,lexicon,rng)[0]
+                        f.write('  <kw kwid="KW202-%05d">\n    <kwtext>%s</kwtext>\n  </kw>\n' % (keyword_index+1," ".join(query_words)))
+                f.write('</kwlist>\n')
+
+def generate_benchmark_data(path_to_directory,config):
+        # writes the synthetic data described by config in path_to_directory, and returns the paths of the files and their sizes
+        rng = np.random.default_rng(config["seed"])
+        os.makedirs(path_to_directory,exist_ok=True)
+        paths = OrderedDict([(name,os.path.join(path_to_directory,file_name)) for name, file_name in [("ctm","decoding.ctm"),("dct","lexicon.dct"),
+                ("map","grapheme.map"),("kwlist","kwlist.xml"),("morph_ctm","decoding.morph.ctm"),("proxy_kwlist","kwlist.proxy.xml"),
+                ("word_hits","hits.word.xml"),("morph_hits","hits.morph.xml"),("normalized_hits","hits.normalized.xml"),("combined_hits","hits.combined.xml")]])
+        lexicon = generate_lexicon(config["vocabulary_size"],rng)
+        write_dct(paths["dct"],lexicon)
+        write_grapheme_confusion_counts(paths["map"],lexicon,rng)
+        n_lines = write_CTM(paths["ctm"],lexicon,config["hours"],config["n_files"],config["silence_rate"],rng)
+        write_kwlist(paths["kwlist"],lexicon,config["n_keywords"],config["oov_rate"],config["multi_word_rate"],rng)
+        return paths, OrderedDict([("n_CTM_lines",n_lines),("n_words",len(lexicon)),("n_keywords",config["n_keywords"])])
+
+
+def measure_stage(run,repeat=3,profile_memory=True):
+        """
+        Times run (a function without arguments) repeat times, and measures the peak of the memory it allocates
+        (with tracemalloc, in a separate run so that the overhead of tracing does not inflate the timings)
+        """
+        times = []
+        for repetition in range(repeat):
+                start_time = time.perf_counter()
+                run()
+                times.append(time.perf_counter() - start_time)
+        measurement = OrderedDict([("time",min(times)),("times",times)])
+        if profile_memory:
+                tracemalloc.start()
+                try:
+                        run()
+                        measurement["peak_memory"] = tracemalloc.get_traced_memory()[1]
+                finally:
+                        tracemalloc.stop()
+        return measurement
+
+def count_hits(path_to_XML_list_of_hits):
+        return sum(len(detected_kwlist) for detected_kwlist in XML_list_reader(path_to_XML_list_of_hits))
+
+def run_benchmark(path_to_directory,config=None,repeat=3,profile_memory=True):
+        """
+        Generates the synthetic data of config (DEFAULT_BENCHMARK_CONFIG by default) in path_to_directory, and measures
+        (see measure_stage) each stage of the pipeline on it:
+        - indexing: Index.index_CTM_document on the CTM file
+        - decomposition: Morph_Decomposer.morph_decompose_CTM_decoding on the CTM file
+        - morph_indexing: Index.index_CTM_document with the Morph_Decomposer (word and morph levels in one pass)
+        - oov_mapping: Grapheme_Based_Mapper.map_XML_queries_into_proxy_IV_XML_queries on the kwlist (with an empty memo each time)
+        - search and morph_search: Index.perform_KWS on the mapped kwlist, at the word and morph levels
+        - normalization: Normalize_score (STO) on the word-level hits
+        - combination: System_Combiner.merge_XML_lists_of_hits_files on the word-level and morph-level hits (CombMNZ)
+        Returns the results as a dictionary (see write_results)
+        """
+        config = OrderedDict(DEFAULT_BENCHMARK_CONFIG if config is None else config)
+        paths, data = generate_benchmark_data(path_to_directory,config)
+        morph_decomposer = Morph_Decomposer()
+        morph_decomposer.load_decomposition_mapping_decoded_speech(paths["dct"])
+        morph_decomposer.load_decomposition_mapping_query_list(paths["dct"])
+        index = Index()
+
+        def run_OOV_mapping():
+                grapheme_based_mapper = Grapheme_Based_Mapper()
+                grapheme_based_mapper.load_confusion_matrix(paths["map"])
+                grapheme_based_mapper.read_dct_get_vocabulary(paths["dct"])
+                grapheme_based_mapper.map_XML_queries_into_proxy_IV_XML_queries(paths["kwlist"],paths["proxy_kwlist"])
+
+        stages = OrderedDict()
+        stages["indexing"] = lambda: Index().index_CTM_document(paths["ctm"])
+        stages["decomposition"] = lambda: morph_decomposer.morph_decompose_CTM_decoding(paths["ctm"],paths["morph_ctm"])
+        stages["morph_indexing"] = lambda: index.index_CTM_document(paths["ctm"],morph_decomposer)
+        stages["oov_mapping"] = run_OOV_mapping
+        stages["search"] = lambda: index.perform_KWS(paths["proxy_kwlist"],paths["word_hits"])
+        stages["morph_search"] = lambda: index.perform_KWS(paths["proxy_kwlist"],paths["morph_hits"],level="morph")
+        stages["normalization"] = lambda: Normalize_score(paths["word_hits"],paths["normalized_hits"],"STO")
+        stages["combination"] = lambda: System_Combiner().merge_XML_lists_of_hits_files([paths["word_hits"],paths["morph_hits"]],paths["combined_hits"],["word","morph"],{"word":0.5,"morph":0.4},"CombMNZ")
+        results = OrderedDict([("version",BENCHMARK_FILE_VERSION),("config",config),("environment",OrderedDict([("python",platform.python_version()),
+                ("numpy",np.__version__),("platform",platform.platform()),("n_cpus",os.cpu_count())])),("data",data),("stages",OrderedDict())])
+        for stage_name, run in stages.items():
+                results["stages"][stage_name] = measure_stage(run,repeat,profile_memory)
+        data["n_word_hits"] = count_hits(paths["word_hits"])
+        data["n_morph_hits"] = count_hits(paths["morph_hits"])
+        data["n_combined_hits"] = count_hits(paths["combined_hits"])
+        return results
+
+
+def write_results(path_to_results_file,results):
+        with open(path_to_results_file,"w") as f:
+                json.dump(results,f,indent=2)
+
+def read_results(path_to_results_file):
+        with open(path_to_results_file,"r") as f:
+                return json.load(f,object_pairs_hook=OrderedDict)
+
+def compare_to_baseline(results,baseline,tolerance=0.25,min_time=0.01):
+        """
+        Returns the list of the regressions of results with respect to baseline (both as returned by run_benchmark):
+        the stages whose time or peak memory exceeds the one of the baseline by more than a fraction tolerance
+        (times below min_time seconds in both runs are ignored, being dominated by noise)
+        Raises a ValueError if the baseline was measured with another configuration
+        """
+        if baseline.get("version") != BENCHMARK_FILE_VERSION or dict(baseline["config"]) != dict(results["config"]):
+                raise ValueError("the baseline was measured with another configuration")
+        regressions = []
+        for stage_name, measurement in results["stages"].items():
+                if stage_name not in baseline["stages"]:
+                        continue
+                baseline_measurement = baseline["stages"][stage_name]
+                if max(measurement["time"],baseline_measurement["time"]) >= min_time and measurement["time"] > (1+tolerance)*baseline_measurement["time"]:
+                        regressions.append("%s: time %.3fs against %.3fs in the baseline (%+.0f%%)" % (stage_name,measurement["time"],baseline_measurement["time"],100*(measurement["time"]/baseline_measurement["time"]-1)))
+                if "peak_memory" in measurement and "peak_memory" in baseline_measurement and measurement["peak_memory"] > (1+tolerance)*baseline_measurement["peak_memory"]:
+                        regressions.append("%s: peak memory %d bytes against %d bytes in the baseline (%+.0f%%)" % (stage_name,measurement["peak_memory"],baseline_measurement["peak_memory"],100*(measurement["peak_memory"]/max(1,baseline_measurement["peak_memory"])-1)))
+        return regressions
+
+
+def main(arguments=None):
+        parser = argparse.ArgumentParser(description="Benchmarks the keyword spotting pipeline on synthetic data")
+        parser.add_argument("--directory",default="benchmark_data",help="directory of the synthetic data and outputs")
+        parser.add_argument("--output",default="benchmark_results.json",help="file where the results are written")
+        parser.add_argument("--baseline",default=None,help="results of a previous run to compare against")
+        parser.add_argument("--tolerance",type=float,default=0.25,help="relative slowdown (or memory increase) reported as a regression")
+        parser.add_argument("--repeat",type=int,default=3,help="number of timed runs of each stage")
+        parser.add_argument("--no-memory",action="store_true",help="do not measure the peak memory of the stages")
+        for name, value in DEFAULT_BENCHMARK_CONFIG.items():
+                parser.add_argument("--" + name.replace("_","-"),type=type(value),default=value)
+        arguments = parser.parse_args(arguments)
+        config = OrderedDict((name,getattr(arguments,name)) for name in DEFAULT_BENCHMARK_CONFIG)
+        results = run_benchmark(arguments.directory,config,arguments.repeat,not arguments.no_memory)
+        write_results(arguments.output,results)
+        for stage_name, measurement in results["stages"].items():
+                print("%-15s %9.3fs" % (stage_name,measurement["time"]) + ("  %8.1f MB" % (measurement["peak_memory"]/2**20) if "peak_memory" in measurement else ""))
+        if arguments.baseline is not None:
+                regressions = compare_to_baseline(results,read_results(arguments.baseline),arguments.tolerance)
+                for regression in regressions:
+                        print("regression: " + regression)
+                return 1 if len(regressions) != 0 else 0
+        return 0
+
+
+if __name__ == "__main__":
+        sys.exit(main())
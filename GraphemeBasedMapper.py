@@ -1,7 +1,12 @@
 import xml.etree.ElementTree as ET
 import numpy as np
 from collections import OrderedDict
+from multiprocessing import Pool
+import hashlib
+import json
+import os
 from Index import Speech_entity
+from Instrumentation import get_instrumentation
 
 class Grapheme_Based_Mapper():
         """
@@ -12,26 +17,49 @@ class Grapheme_Based_Mapper():
         - self.confusion_matrix["a"]["t"] = log(P("t" recognized| "a" reference))
         - self.vocabulary is a set (for O(1) access on average)
         - self.map_to_proxy_IV_words is a dictionary that stores (in order not to do the same computations twice)
-        the closest IV word associated to an OOV word (once it has appeared in a query)
+        the closest IV word associated to an OOV word (once it has appeared in a query), from the least to the most recently used
+        - self.proxy_cache_path and self.proxy_cache_size describe the on-disk cache of self.map_to_proxy_IV_words (if any),
+        and self.proxy_cache_fingerprint the fingerprint it was loaded for (reloading the .map or .dct file detaches the cache)
 
         - load_confusion_matrix reads a .map file and stores the information in self.confusion_matrix
         - read_dct_get_vocabulary reads a .dct file (which maps IV words to their morphological decomposition)
         and stores the vocabulary in self.vocabulary (the morphological decomposition is ignored)
         - map_XML_queries_into_proxy_IV_XML_queries reads a XML file of queries and replaces every OOV word
         by the closes IV word using self.closest_IV_word
+        (the distinct OOV words that are not yet in self.map_to_proxy_IV_words can be spread across n_processes processes),
+        and map_queries_into_proxy_IV_queries does the same with a batch of queries given as lists of words
+        - load_proxy_cache(path_to_cache_directory,max_entries) attaches an on-disk cache of self.map_to_proxy_IV_words,
+        stored in a file named after get_fingerprint() (a hash of the confusion matrix and of the vocabulary) so that it is
+        only reused with the same .map and .dct files, and save_proxy_cache writes it back after evicting the least recently used entries
         - closest_IV_word(word) finds the closest word in self.vocabulary for the distance given by self.distance
         - distance(word1,word2) computes the log likelihood of word2 being recognized when word1 was said
         (it is not really a distance; in particular, it is not symmetric)
         The distance is computed using the confusion matrix and a variant of the Wagner-Fisher algorithm
+        - the current instrumentation (see Instrumentation) counts the dynamic programming cells computed (mapper.dp_cells),
+        the hits and misses of self.map_to_proxy_IV_words and the vocabulary words scored or pruned by the search engine
+        - get_search_engine returns a Vocabulary_Search_Engine built from the current confusion matrix and vocabulary
+        (it is built once and cached in self.search_engine, and discarded whenever one of them is reloaded),
+        which closest_IV_word uses to score the whole vocabulary at once
+        - confusable_neighbors(list_of_words,vocabulary,k) returns the k most confusable words of another vocabulary
+        for each word (see Index.build_neighbor_table)
 
         """
         def __init__(self):
                 self.confusion_matrix=dict()
                 self.vocabulary={}
-                self.map_to_proxy_IV_words=dict()
+                self.map_to_proxy_IV_words=OrderedDict()
+                self.search_engine=None
+                self.proxy_cache_path=None
+                self.proxy_cache_fingerprint=None
+                self.proxy_cache_size=100000
 
         def load_confusion_matrix(self,path_to_grapheme_confusion_file):
                 self.confusion_matrix=dict()
+                self.search_engine=None
+                self.map_to_proxy_IV_words=OrderedDict()
+                # the on-disk cache belongs to the previous confusion matrix and vocabulary (see load_proxy_cache)
+                self.proxy_cache_path=None
+                self.proxy_cache_fingerprint=None
                 grapheme_map = open(path_to_grapheme_confusion_file,"r")
                 for line in grapheme_map:
                         ref_grapheme = line.split()[0]
@@ -51,6 +79,7 @@ class Grapheme_Based_Mapper():
         def distance(self,word1,word2):
                 m1 = len(word1)
                 m2 = len(word2)
+                get_instrumentation().increment("mapper.dp_cells",m1*m2)
                 D = dict()
                 for i in range(m1+1):
                         for j in range(m2+1):
@@ -87,27 +116,231 @@ class Grapheme_Based_Mapper():
                         vocabulary.append(line.split()[0])
                 # to make access O(1) on average
                 self.vocabulary = set(vocabulary)
+                self.search_engine=None
+                self.map_to_proxy_IV_words=OrderedDict()
+                # the on-disk cache belongs to the previous confusion matrix and vocabulary (see load_proxy_cache)
+                self.proxy_cache_path=None
+                self.proxy_cache_fingerprint=None
 
-        def map_XML_queries_into_proxy_IV_XML_queries(self,path_to_XML_input,path_to_XML_output):
-                tree=ET.parse(path_to_XML_input)
-                root = tree.getroot()
-                for kw in root:
-                        query_words = kw[0].text.split()
+        def map_XML_queries_into_proxy_IV_XML_queries(self,path_to_XML_input,path_to_XML_output,n_processes=1):
+                with get_instrumentation().timer("mapper.oov_mapping"):
+                        tree=ET.parse(path_to_XML_input)
+                        root = tree.getroot()
+                        list_of_new_query_words = self.map_queries_into_proxy_IV_queries([kw[0].text.split() for kw in root],n_processes)
+                        for kw, new_query_words in zip(root,list_of_new_query_words):
+                                kw[0].text = " ".join(new_query_words)
+                        tree.write(path_to_XML_output)
+                        if self.proxy_cache_path is not None:
+                                self.save_proxy_cache()
+
+        def map_queries_into_proxy_IV_queries(self,list_of_query_words,n_processes=1):
+                # replaces the OOV words of a batch of queries (lists of words), the distinct new OOV words being searched together
+                instrumentation = get_instrumentation()
+                new_OOV_words = OrderedDict()
+                for query_words in list_of_query_words:
+                        for word in query_words:
+                                if word not in self.vocabulary:
+                                        word = self.normalize_OOV_word(word)
+                                        if word not in self.map_to_proxy_IV_words and word not in new_OOV_words:
+                                                instrumentation.increment("mapper.proxy_cache_misses")
+                                                new_OOV_words[word] = None
+                                        else:
+                                                instrumentation.increment("mapper.proxy_cache_hits")
+                new_OOV_words = list(new_OOV_words)
+                with instrumentation.timer("mapper.closest_IV_words"):
+                        self.map_to_proxy_IV_words.update(zip(new_OOV_words,self.closest_IV_words(new_OOV_words,n_processes)))
+                list_of_new_query_words = []
+                for query_words in list_of_query_words:
                         new_query_words = []
                         for word in query_words:
                                 if word not in self.vocabulary:
-                                        word = word.lower()
-                                        word = "".join(letter for letter in word if letter.isalnum())
-                                        if word not in self.map_to_proxy_IV_words:
-                                                self.map_to_proxy_IV_words[word] = self.closest_IV_word(word)
+                                        word = self.normalize_OOV_word(word)
+                                        self.map_to_proxy_IV_words.move_to_end(word)
                                         new_query_words.append(self.map_to_proxy_IV_words[word])
                                 else:
                                         new_query_words.append(word)
-                        kw[0].text = " ".join(new_query_words)
-                tree.write(path_to_XML_output)
+                        list_of_new_query_words.append(new_query_words)
+                return list_of_new_query_words
+
+        def normalize_OOV_word(self,word):
+                word = word.lower()
+                return "".join(letter for letter in word if letter.isalnum())
+
+        def closest_IV_words(self,list_of_words,n_processes=1):
+                if n_processes <= 1 or len(list_of_words) < 2:
+                        return [self.closest_IV_word(word) for word in list_of_words]
+                with Pool(min(n_processes,len(list_of_words)),initializer=_initialize_worker_search_engine,initargs=(self.get_search_engine(),)) as pool:
+                        return pool.map(_worker_closest_IV_word,list_of_words,chunksize=max(1,len(list_of_words)//(4*n_processes)))
+
+        def get_fingerprint(self):
+                fingerprint = hashlib.sha1()
+                for grapheme in sorted(self.confusion_matrix):
+                        fingerprint.update(repr((grapheme,sorted((observation,float(log_proba)) for observation, log_proba in self.confusion_matrix[grapheme].items()))).encode("utf-8"))
+                fingerprint.update("\n".join(sorted(self.vocabulary)).encode("utf-8"))
+                return fingerprint.hexdigest()
+
+        def load_proxy_cache(self,path_to_cache_directory,max_entries=100000):
+                # must be called after load_confusion_matrix and read_dct_get_vocabulary
+                os.makedirs(path_to_cache_directory,exist_ok=True)
+                self.proxy_cache_fingerprint = self.get_fingerprint()
+                self.proxy_cache_path = os.path.join(path_to_cache_directory,self.proxy_cache_fingerprint+".json")
+                self.proxy_cache_size = max_entries
+                if os.path.exists(self.proxy_cache_path):
+                        with open(self.proxy_cache_path,"r") as f:
+                                for OOV_word, IV_word in reversed(json.load(f)["proxy_IV_words"]):
+                                        if OOV_word not in self.map_to_proxy_IV_words:
+                                                self.map_to_proxy_IV_words[OOV_word] = IV_word
+                                                # entries computed in this process are more recent than the ones from the cache
+                                                self.map_to_proxy_IV_words.move_to_end(OOV_word,last=False)
+
+        def save_proxy_cache(self):
+                if self.proxy_cache_fingerprint != self.get_fingerprint():
+                        raise ValueError("the confusion matrix or the vocabulary changed since the proxy cache " + str(self.proxy_cache_path) + " was loaded")
+                while len(self.map_to_proxy_IV_words) > self.proxy_cache_size:
+                        self.map_to_proxy_IV_words.popitem(last=False)
+                temporary_path = self.proxy_cache_path + ".%d.tmp" % os.getpid()
+                with open(temporary_path,"w") as f:
+                        json.dump({"proxy_IV_words":list(self.map_to_proxy_IV_words.items())},f)
+                os.replace(temporary_path,self.proxy_cache_path)
+
+        def get_search_engine(self):
+                if self.search_engine is None:
+                        self.search_engine = Vocabulary_Search_Engine(self.confusion_matrix,self.vocabulary)
+                return self.search_engine
+
+        def confusable_neighbors(self,list_of_words,vocabulary,k,n_processes=1):
+                """
+                Returns, for each word of list_of_words, the list of its k most confusable words of vocabulary (other than itself)
+                as (word, log weight) pairs sorted by decreasing weight, where the log weight of a neighbor is the log likelihood
+                of observing it when the word was said, minus the one of observing the word itself (capped at 0)
+                """
+                search_engine = self.get_vocabulary_search_engine(vocabulary)
+                if n_processes <= 1 or len(list_of_words) < 2:
+                        return [search_engine.confusable_neighbors(word,k) for word in list_of_words]
+                with Pool(min(n_processes,len(list_of_words)),initializer=_initialize_worker_search_engine,initargs=(search_engine,)) as pool:
+                        return pool.map(_worker_confusable_neighbors,[(word,k) for word in list_of_words],chunksize=max(1,len(list_of_words)//(4*n_processes)))
+
+        def get_vocabulary_search_engine(self,vocabulary):
+                # Vocabulary_Search_Engine over another vocabulary (e.g. the tokens of an Index), under the confusion matrix of the mapper
+                return Vocabulary_Search_Engine(self.confusion_matrix,vocabulary)
 
         def closest_IV_word(self,word):
-                distances=dict()
-                for IV_word in self.vocabulary:
-                        distances[IV_word]=self.distance(word.replace("'",""),IV_word.replace("'",""))
-                return min(distances, key=distances.get)
\ No newline at end of file
+                # same result as taking the min of self.distance(word,IV_word) over self.vocabulary
+                # (ties are broken by the iteration order of self.vocabulary, as min would)
+                return self.get_search_engine().closest_words(word,1)[0][0]
+
+
+class Vocabulary_Search_Engine():
+        """
+        Scores a word against a whole vocabulary at once with the same variant of the Wagner-Fisher algorithm
+        as Grapheme_Based_Mapper.distance, and returns the closest vocabulary words
+
+        - graphemes are encoded as integer ids (self.grapheme_ids), id 0 being reserved for graphemes unknown to the .map file
+        - the log-probabilities of the confusion matrix are stored in dense arrays:
+        self.deletion[g], self.insertion[g] and self.substitution[g1,g2] (with the same -40 default as the penalty methods of Grapheme_Based_Mapper)
+        - self.words is the vocabulary in the iteration order of the set it was built from, and the words (with "'" removed)
+        are grouped by length in self.buckets, a list of (length, array of encoded words, array of positions in self.words)
+        - closest_words(word,k) returns the k closest words and their distances, sorted by distance (ties are broken by position in self.words),
+        and confusable_neighbors(word,k) the k closest words other than word, weighted relatively to word itself
+        The dynamic programming is run on a whole bucket at a time, and a bucket is only scored for the words whose upper bound
+        on the log likelihood (each observed grapheme being at best inserted or substituted to one of the graphemes of the word)
+        can still beat the k-th best word found so far (branch-and-bound); the buckets are visited from the most promising one
+        """
+        def __init__(self,confusion_matrix,vocabulary):
+                self.words = list(vocabulary)
+                stripped_words = [IV_word.replace("'","") for IV_word in self.words]
+                graphemes = set(grapheme for grapheme in confusion_matrix if len(grapheme) == 1)
+                for grapheme in confusion_matrix:
+                        graphemes.update(observation for observation in confusion_matrix[grapheme] if len(observation) == 1)
+                for IV_word in stripped_words:
+                        graphemes.update(IV_word)
+                self.grapheme_ids = dict((grapheme,index+1) for index, grapheme in enumerate(sorted(graphemes)))
+                n_graphemes = len(self.grapheme_ids)+1
+                self.deletion = np.full(n_graphemes,-40.0)
+                self.insertion = np.full(n_graphemes,-40.0)
+                self.substitution = np.full((n_graphemes,n_graphemes),-40.0)
+                for grapheme, grapheme_id in self.grapheme_ids.items():
+                        if grapheme in confusion_matrix:
+                                for observation, log_proba in confusion_matrix[grapheme].items():
+                                        if observation in self.grapheme_ids:
+                                                self.substitution[grapheme_id,self.grapheme_ids[observation]] = log_proba
+                                if "sil" in confusion_matrix[grapheme]:
+                                        self.deletion[grapheme_id] = confusion_matrix[grapheme]["sil"]
+                        if "sil" in confusion_matrix and grapheme in confusion_matrix["sil"]:
+                                self.insertion[grapheme_id] = confusion_matrix["sil"][grapheme]
+                lengths = np.array([len(IV_word) for IV_word in stripped_words],dtype=np.int64)
+                self.buckets = []
+                for length in np.unique(lengths):
+                        positions = np.flatnonzero(lengths == length)
+                        codes = np.array([self.encode(stripped_words[position]) for position in positions],dtype=np.int64).reshape(len(positions),length)
+                        self.buckets.append((int(length),codes,positions))
+
+        def encode(self,word):
+                return [self.grapheme_ids.get(grapheme,0) for grapheme in word]
+
+        def log_likelihoods(self,reference_codes,codes):
+                # D[i,j] of Grapheme_Based_Mapper.distance, for every row of codes at once (one column per j)
+                n_words, length = codes.shape
+                get_instrumentation().increment("mapper.dp_cells",n_words*length*len(reference_codes))
+                insertions = self.insertion[codes]
+                D_previous = np.zeros((n_words,length+1))
+                for j in range(1,length+1,1):
+                        D_previous[:,j] = D_previous[:,j-1] + insertions[:,j-1]
+                for reference_code in reference_codes:
+                        deletion = self.deletion[reference_code]
+                        D_current = np.empty((n_words,length+1))
+                        D_current[:,0] = D_previous[:,0] + deletion
+                        deletion_or_substitution = np.maximum(D_previous[:,1:] + deletion, D_previous[:,:-1] + self.substitution[reference_code][codes])
+                        for j in range(1,length+1,1):
+                                D_current[:,j] = np.maximum(deletion_or_substitution[:,j-1], D_current[:,j-1] + insertions[:,j-1])
+                        D_previous = D_current
+                return D_previous[:,length]
+
+        def closest_words(self,word,k):
+                reference_codes = self.encode(word.replace("'",""))
+                # best log likelihood with which each grapheme can be consumed (by an insertion or a substitution)
+                best_consumption = self.insertion.copy()
+                if len(reference_codes) > 0:
+                        best_consumption = np.maximum(best_consumption, self.substitution[reference_codes].max(axis=0))
+                upper_bounds = [best_consumption[codes].sum(axis=1) for length, codes, positions in self.buckets]
+                best_log_likelihoods = np.empty(0)
+                best_positions = np.empty(0,dtype=np.int64)
+                instrumentation = get_instrumentation()
+                for bucket_index in np.argsort([-bound.max() if len(bound) != 0 else np.inf for bound in upper_bounds],kind="stable"):
+                        length, codes, positions = self.buckets[bucket_index]
+                        candidates = np.ones(len(positions),dtype=bool)
+                        if len(best_positions) == k:
+                                # tolerance for the different summation order of the bound
+                                candidates = upper_bounds[bucket_index] >= best_log_likelihoods[-1] - 10**(-6)
+                                n_candidates = int(np.count_nonzero(candidates))
+                                instrumentation.increment("mapper.words_pruned",len(positions) - n_candidates)
+                                if n_candidates == 0:
+                                        continue
+                        instrumentation.increment("mapper.words_scored",int(np.count_nonzero(candidates)))
+                        best_log_likelihoods = np.concatenate([best_log_likelihoods,self.log_likelihoods(reference_codes,codes[candidates])])
+                        best_positions = np.concatenate([best_positions,positions[candidates]])
+                        order = np.lexsort((best_positions,-best_log_likelihoods))[:k]
+                        best_log_likelihoods = best_log_likelihoods[order]
+                        best_positions = best_positions[order]
+                return [(self.words[position], -log_likelihood) for position, log_likelihood in zip(best_positions,best_log_likelihoods)]
+
+        def confusable_neighbors(self,word,k):
+                reference_codes = self.encode(word.replace("'",""))
+                self_log_likelihood = self.log_likelihoods(reference_codes,np.array([reference_codes],dtype=np.int64).reshape(1,len(reference_codes)))[0]
+                neighbors = [(IV_word, distance) for IV_word, distance in self.closest_words(word,k+1) if IV_word != word][:k]
+                return [(IV_word, min(0.0,float(-distance - self_log_likelihood))) for IV_word, distance in neighbors]
+
+
+# search engine of the worker processes of Grapheme_Based_Mapper.closest_IV_words and Grapheme_Based_Mapper.confusable_neighbors
+_worker_search_engine = None
+
+def _initialize_worker_search_engine(search_engine):
+        global _worker_search_engine
+        _worker_search_engine = search_engine
+
+def _worker_closest_IV_word(word):
+        return _worker_search_engine.closest_words(word,1)[0][0]
+
+def _worker_confusable_neighbors(task):
+        word, k = task
+        return _worker_search_engine.confusable_neighbors(word,k)
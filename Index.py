@@ -1,6 +1,71 @@
 import xml.etree.ElementTree as ET
 import numpy as np
-from collections import OrderedDict
+from collections import OrderedDict, Counter
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+import weakref
+from multiprocessing import Pool
+from XMLListIO import XML_list_reader, XML_list_writer
+from Instrumentation import get_instrumentation
+
+
+ARRAY_FILE_MAGIC = b"KWSARRAY"
+ARRAY_FILE_ALIGNMENT = 64
+
+def file_checksum(path_to_file):
+        checksum = hashlib.sha1()
+        with open(path_to_file,"rb") as f:
+                for block in iter(lambda: f.read(1<<20),b""):
+                        checksum.update(block)
+        return checksum.hexdigest()
+
+def write_array_file(path_to_file,header,arrays):
+        """
+        Writes a binary file made of a magic string, the length of a JSON header, the JSON header
+        (the dictionary header, to which the dtype, shape and offset of each array are added under "arrays")
+        and the raw content of the arrays of the dictionary arrays, each aligned on ARRAY_FILE_ALIGNMENT bytes
+        The file is first written under a temporary name, so that readers never see a partially written file
+        """
+        header = dict(header)
+        header["arrays"] = OrderedDict()
+        offset = 0
+        for name, array in arrays.items():
+                header["arrays"][name] = {"dtype":array.dtype.str,"shape":list(array.shape),"offset":offset}
+                offset += -(-array.nbytes // ARRAY_FILE_ALIGNMENT) * ARRAY_FILE_ALIGNMENT
+        encoded_header = json.dumps(header).encode("utf-8")
+        data_start = -(-(len(ARRAY_FILE_MAGIC) + 8 + len(encoded_header)) // ARRAY_FILE_ALIGNMENT) * ARRAY_FILE_ALIGNMENT
+        temporary_path = path_to_file + ".%d.tmp" % os.getpid()
+        with open(temporary_path,"wb") as f:
+                f.write(ARRAY_FILE_MAGIC + struct.pack("<Q",len(encoded_header)) + encoded_header)
+                for name, array in arrays.items():
+                        f.seek(data_start + header["arrays"][name]["offset"])
+                        f.write(np.ascontiguousarray(array).tobytes())
+                f.truncate(data_start + offset)
+        os.replace(temporary_path,path_to_file)
+
+def read_array_file(path_to_file):
+        """
+        Reads a file written by write_array_file, and returns its header and a dictionary of read-only memory-mapped arrays
+        (the pages of the file are therefore shared by all the processes that read it)
+        """
+        with open(path_to_file,"rb") as f:
+                if f.read(len(ARRAY_FILE_MAGIC)) != ARRAY_FILE_MAGIC:
+                        raise ValueError(path_to_file + " is not an array file")
+                header_length = struct.unpack("<Q",f.read(8))[0]
+                header = json.loads(f.read(header_length).decode("utf-8"))
+        data_start = -(-(len(ARRAY_FILE_MAGIC) + 8 + header_length) // ARRAY_FILE_ALIGNMENT) * ARRAY_FILE_ALIGNMENT
+        arrays = OrderedDict()
+        for name, description in header["arrays"].items():
+                shape = tuple(description["shape"])
+                if np.prod(shape) == 0:
+                        arrays[name] = np.zeros(shape,dtype=description["dtype"])
+                else:
+                        arrays[name] = np.memmap(path_to_file,dtype=description["dtype"],mode="r",offset=data_start+description["offset"],shape=shape)
+        return header, arrays
 
 
 class Speech_entity():
@@ -21,64 +86,991 @@ class Speech_entity():
         def get_values(self):
                 return [self.file_name,self.channel,self.tbeg,self.tdur,self.tend,self.token,self.posterior]
 
+SPEECH_COLUMNS = ["token_column","file_column","channel_column","tbeg","tdur","posterior"]
+
+class Speech_columns():
+        """
+        Columnar storage of the entries of a CTM ASR output file (one row per entry), used by Index
+        - self.token_column, self.file_column and self.channel_column are int32 arrays of ids
+        (interned by the Index that owns the columns), and self.tbeg, self.tdur and self.posterior are float64 arrays
+        - a silence of more than 0.5 second, or a change of file or channel, is represented by a row whose token id is -1
+        (the None entries of the former list of Speech_entity), which makes the identification of phrases easier
+        - self.posting_offsets and self.postings store the occurence index: the rows where the token of id i occurs
+        are self.postings[self.posting_offsets[i]:self.posting_offsets[i+1]], in increasing order
+        - self.file_ids_present is the sorted array of the ids of the files that have rows in the columns,
+        and self.removed_file_ids the set of those whose rows must be ignored (see Index.remove_file)
+        - self.log_posterior is the log of self.posterior (used by the pruned searches), computed by get_log_posterior when first needed
+        """
+        def __init__(self,token_column,file_column,channel_column,tbeg,tdur,posterior):
+                self.token_column = token_column
+                self.file_column = file_column
+                self.channel_column = channel_column
+                self.tbeg = tbeg
+                self.tdur = tdur
+                self.posterior = posterior
+                self.posting_offsets = np.zeros(1,dtype=np.int64)
+                self.postings = np.zeros(0,dtype=np.int64)
+                self.file_ids_present = np.unique(file_column[file_column >= 0]).astype(np.int32)
+                self.removed_file_ids = set()
+                self.log_posterior = None
+
+        def __len__(self):
+                return len(self.token_column)
+
+        def build_postings(self,n_tokens):
+                order = np.argsort(self.token_column,kind="stable")
+                self.postings = order[self.token_column[order] >= 0].astype(np.int64)
+                counts = np.bincount(self.token_column[self.token_column >= 0],minlength=n_tokens)
+                self.posting_offsets = np.concatenate([[0],np.cumsum(counts)]).astype(np.int64)
+
+        def get_postings(self,token_id):
+                if token_id + 1 >= len(self.posting_offsets):
+                        return self.postings[:0]
+                return self.postings[self.posting_offsets[token_id]:self.posting_offsets[token_id+1]]
+
+        def get_live_rows(self):
+                # boolean mask of the rows that are entries of files that have not been removed
+                live_rows = self.token_column >= 0
+                if len(self.removed_file_ids) != 0:
+                        live_rows &= ~np.isin(self.file_column,list(self.removed_file_ids))
+                return live_rows
+
+        def restrict_to_files(self,file_ids,n_tokens):
+                # copy of the segment where the rows of the files that are not in file_ids are silences
+                # (the other columns are shared with this segment)
+                kept_rows = self.get_live_rows() & np.isin(self.file_column,file_ids)
+                segment = Speech_columns(np.where(kept_rows,self.token_column,-1).astype(np.int32),self.file_column,self.channel_column,self.tbeg,self.tdur,self.posterior)
+                segment.build_postings(n_tokens)
+                return segment
+
+        def find_phrase(self,query_ids):
+                # rows where the sequence of token ids query_ids starts
+                return self.find_phrases([query_ids])[0]
+
+        def find_phrases(self,list_of_query_ids,query_times=None):
+                """
+                Returns, for each query of list_of_query_ids, the rows where its sequence of token ids starts
+                Each query is anchored on its rarest term, and the other terms are added by positional intersection
+                of the posting lists (rarest first); the result of a prefix shared by several queries of the batch
+                (or of a query repeated in the batch) is only computed once
+                The time spent on each query is added to query_times (if given, with one entry per query)
+                """
+                list_of_query_ids = [tuple(query_ids) for query_ids in list_of_query_ids]
+                query_counts = Counter(list_of_query_ids)
+                prefix_counts = dict()
+                for query_ids in query_counts:
+                        for length in range(2,len(query_ids)+1,1):
+                                prefix_counts[query_ids[:length]] = prefix_counts.get(query_ids[:length],0) + 1
+                        if query_counts[query_ids] > 1:
+                                prefix_counts[query_ids] = 2
+                shared_results = dict()
+                removed_file_ids = list(self.removed_file_ids)
+                list_of_positions = []
+                for query_index, query_ids in enumerate(list_of_query_ids):
+                        start_time = time.perf_counter()
+                        positions = self.evaluate_phrase(query_ids,prefix_counts,shared_results)
+                        if len(removed_file_ids) != 0:
+                                positions = positions[~np.isin(self.file_column[positions],removed_file_ids)]
+                        list_of_positions.append(positions)
+                        if query_times is not None:
+                                query_times[query_index] += time.perf_counter() - start_time
+                return list_of_positions
+
+        def evaluate_phrase(self,query_ids,prefix_counts,shared_results):
+                if query_ids in shared_results:
+                        return shared_results[query_ids]
+                shared_prefix_length = 0
+                for length in range(len(query_ids)-1,1,-1):
+                        if prefix_counts.get(query_ids[:length],0) > 1:
+                                shared_prefix_length = length
+                                break
+                if shared_prefix_length != 0:
+                        positions = self.evaluate_phrase(query_ids[:shared_prefix_length],prefix_counts,shared_results)
+                        remaining_offsets = list(range(shared_prefix_length,len(query_ids)))
+                        n_scanned_postings = 0
+                else:
+                        posting_lengths = [len(self.get_postings(token_id)) for token_id in query_ids]
+                        anchor = int(np.argmin(posting_lengths))
+                        positions = self.get_postings(query_ids[anchor]) - anchor
+                        n_scanned_postings = len(positions)
+                        positions = positions[positions >= 0]
+                        remaining_offsets = [offset for offset in range(len(query_ids)) if offset != anchor]
+                remaining_offsets.sort(key=lambda offset: len(self.get_postings(query_ids[offset])))
+                for offset in remaining_offsets:
+                        if len(positions) == 0:
+                                break
+                        postings = self.get_postings(query_ids[offset])
+                        n_scanned_postings += len(postings)
+                        positions = intersect_positions(positions,postings,offset)
+                instrumentation = get_instrumentation()
+                instrumentation.increment("index.phrases_evaluated")
+                instrumentation.increment("index.postings_scanned",n_scanned_postings)
+                if prefix_counts.get(query_ids,0) > 1:
+                        shared_results[query_ids] = positions
+                return positions
+
+
+        def get_candidate_postings(self,candidate_ids,candidate_log_weights):
+                # rows where one of the tokens of candidate_ids occurs (in increasing order), with the log weight of that token
+                postings = [self.get_postings(token_id) for token_id in candidate_ids]
+                log_weights = np.repeat(np.asarray(candidate_log_weights,dtype=np.float64),[len(token_postings) for token_postings in postings])
+                postings = np.concatenate(postings) if len(postings) != 0 else self.postings[:0]
+                order = np.argsort(postings,kind="stable")
+                return postings[order], log_weights[order]
+
+        def get_log_posterior(self):
+                # log of the posterior column, computed the first time it is needed
+                if self.log_posterior is None:
+                        with np.errstate(divide="ignore"):
+                                self.log_posterior = np.log(self.posterior)
+                return self.log_posterior
+
+        def find_weighted_phrases(self,list_of_query_candidates,min_log_score=None,query_times=None):
+                """
+                Returns, for each query of list_of_query_candidates, the rows where it starts along with the log weight and the log score of each match
+                A query is given as one (array of token ids, array of log weights) pair of candidates per term: a term matches a row
+                where any of its candidates occurs, and the log weight of a match is the sum of the log weights of the candidates it is made of
+                (a row holds a single token, so that there is at most one match per row); its log score adds the log posteriors of its rows
+                The query is anchored on the term with the fewest candidate rows, as in find_phrases, and the log score is accumulated
+                as the other terms are intersected: since log weights and log posteriors are <= 0, a partial match whose log score
+                is below min_log_score (if given) can be dropped right away
+                The time spent on each query is added to query_times (if given), as in find_phrases
+                """
+                removed_file_ids = list(self.removed_file_ids)
+                log_posterior = self.get_log_posterior()
+                instrumentation = get_instrumentation()
+                results = []
+                for query_index, query_candidates in enumerate(list_of_query_candidates):
+                        start_time = time.perf_counter()
+                        n_pruned_matches = 0
+                        candidate_postings = [self.get_candidate_postings(candidate_ids,candidate_log_weights) for candidate_ids, candidate_log_weights in query_candidates]
+                        offsets = sorted(range(len(candidate_postings)),key=lambda offset: len(candidate_postings[offset][0]))
+                        positions, log_weights = candidate_postings[offsets[0]]
+                        n_scanned_postings = len(positions)
+                        log_scores = log_weights + log_posterior[positions]
+                        positions = positions - offsets[0]
+                        kept = positions >= 0
+                        if min_log_score is not None:
+                                n_pruned_matches += int(np.count_nonzero(kept & (log_scores < min_log_score)))
+                                kept &= log_scores >= min_log_score
+                        positions, log_weights, log_scores = positions[kept], log_weights[kept], log_scores[kept]
+                        for offset in offsets[1:]:
+                                if len(positions) == 0:
+                                        break
+                                postings, posting_log_weights = candidate_postings[offset]
+                                n_scanned_postings += len(postings)
+                                position_indices, posting_indices = match_positions(positions,postings,offset)
+                                positions = positions[position_indices]
+                                log_weights = log_weights[position_indices] + posting_log_weights[posting_indices]
+                                log_scores = log_scores[position_indices] + posting_log_weights[posting_indices] + log_posterior[postings[posting_indices]]
+                                if min_log_score is not None:
+                                        kept = log_scores >= min_log_score
+                                        n_pruned_matches += len(kept) - int(np.count_nonzero(kept))
+                                        positions, log_weights, log_scores = positions[kept], log_weights[kept], log_scores[kept]
+                        if len(removed_file_ids) != 0:
+                                live = ~np.isin(self.file_column[positions],removed_file_ids)
+                                positions, log_weights, log_scores = positions[live], log_weights[live], log_scores[live]
+                        results.append((positions,log_weights,log_scores))
+                        instrumentation.increment("index.phrases_evaluated")
+                        instrumentation.increment("index.postings_scanned",n_scanned_postings)
+                        instrumentation.increment("index.partial_matches_pruned",n_pruned_matches)
+                        if query_times is not None:
+                                query_times[query_index] += time.perf_counter() - start_time
+                return results
+
+
+def intersect_positions(positions,postings,offset):
+        # elements p of the sorted array positions such that p+offset is in the sorted array postings
+        # (the smallest of the two arrays is binary searched in the largest one)
+        targets = positions + offset
+        if len(targets) == 0 or len(postings) == 0:
+                return positions[:0]
+        if len(targets) <= len(postings):
+                indices = np.minimum(np.searchsorted(postings,targets),len(postings)-1)
+                return positions[postings[indices] == targets]
+        indices = np.minimum(np.searchsorted(targets,postings),len(targets)-1)
+        return positions[indices[targets[indices] == postings]]
+
+
+def match_positions(positions,postings,offset):
+        # same as intersect_positions, but returns the indices in positions and in postings of the matches
+        targets = positions + offset
+        if len(targets) == 0 or len(postings) == 0:
+                return np.zeros(0,dtype=np.int64), np.zeros(0,dtype=np.int64)
+        if len(targets) <= len(postings):
+                indices = np.minimum(np.searchsorted(postings,targets),len(postings)-1)
+                matches = np.flatnonzero(postings[indices] == targets)
+                return matches, indices[matches]
+        indices = np.minimum(np.searchsorted(targets,postings),len(targets)-1)
+        matches = np.flatnonzero(targets[indices] == postings)
+        return indices[matches], matches
+
+
+def select_top_scores(log_scores,top_k):
+        # indices (in increasing order) of the top_k highest log scores, ties being broken by index
+        if top_k is None or len(log_scores) <= top_k:
+                return np.arange(len(log_scores))
+        return np.sort(np.lexsort((np.arange(len(log_scores)),-np.asarray(log_scores)))[:top_k])
+
+def escape_attribute(value):
+        # value escaped as an attribute value by ElementTree (with the us-ascii encoding), as bytes
+        return ET.tostring(ET.Element("kw",{"file":value}),encoding="us-ascii")[len(b'<kw file="'):-len(b'" />')]
+
+
+class Serialized_hits():
+        """
+        Hits of a query whose kw elements are already serialized (see Index.serialize_hits): content holds their bytes
+        (in the order of the output), and len gives their number
+        """
+        def __init__(self,content,n_hits):
+                self.content = content
+                self.n_hits = n_hits
+
+        def __len__(self):
+                return self.n_hits
+
+
+class Neighbor_table():
+        """
+        Confusable neighbors of the tokens of an Index at one level (see Index.build_neighbor_table)
+        - the neighbors of the token of id i are self.neighbor_ids[self.offsets[i]:self.offsets[i+1]] (token ids, from the most
+        to the least confusable), and self.log_weights holds their log weights (log likelihood of observing the neighbor when the token
+        was said, relatively to observing the token itself, so that they are <= 0)
+        - self.header describes how the table was built: level, k, the fingerprint of the Grapheme_Based_Mapper (confusion matrix
+        and vocabulary) and the checksum of the tokens the neighbors were chosen among, which tell whether it is stale
+        - get_candidates(token_id) returns the ids and log weights of the token itself (with log weight 0) followed by its neighbors,
+        and has_entry(token_id) whether the neighbors of the token were searched when the table was built (they were not for the tokens
+        of the other level, or the ones added to the index afterwards)
+        - self.grapheme_based_mapper is the Grapheme_Based_Mapper the table was built or loaded with (if any), with which the neighbors
+        of the tokens without entry are searched at query time (see Index.search_token_candidates); self.search_engine is its
+        Vocabulary_Search_Engine over the tokens of the level, and self.searched_candidates caches the candidates found with it
+        """
+        def __init__(self,offsets,neighbor_ids,log_weights,header,grapheme_based_mapper=None):
+                self.offsets = offsets
+                self.neighbor_ids = neighbor_ids
+                self.log_weights = log_weights
+                self.header = header
+                self.grapheme_based_mapper = grapheme_based_mapper
+                self.search_engine = None
+                self.searched_candidates = dict()
+
+        def has_entry(self,token_id):
+                if token_id + 1 >= len(self.offsets):
+                        return False
+                # with k > 0, every token of the level has at least one neighbor (unless it is the only one)
+                return self.header["k"] == 0 or self.offsets[token_id+1] > self.offsets[token_id]
+
+        def get_candidates(self,token_id):
+                if token_id + 1 >= len(self.offsets):
+                        return np.array([token_id],dtype=np.int32), np.zeros(1)
+                start, end = self.offsets[token_id], self.offsets[token_id+1]
+                return np.concatenate([[token_id],self.neighbor_ids[start:end]]).astype(np.int32), np.concatenate([[0.0],self.log_weights[start:end]])
+
+
+INDEX_FILE_VERSION = 3
+NEIGHBOR_TABLE_FILE_VERSION = 1
+
 class Index():
         """
         Main indexing class
         Its attributes are:
-        - formatted_speech : a list whose entries are either Speech_entity or None  ,
-        where each entry represents either a word/subword with associated data (beginning time, etc.),
-        or a silence of more than 0.5 second (in the case of None) (this makes the identification of phrases easier)
-        - occurence_index: a dictionary where each word is mapped to the list of indices of the entries in formatted_speech
-        where it occurs (example: occurence_index["abandon"]=[2, 36])
+        - segments : a list of Speech_columns instances (one per batch of CTM entries added to the index),
+        where each row represents either a word/subword with associated data (beginning time, etc.),
+        or a silence of more than 0.5 second (this makes the identification of phrases easier)
+        A phrase never spans two segments, nor two files or channels within a segment
+        - morph_segments : if the index was built with a Morph_Decomposer (self.morph_decomposer), the morph-level counterpart
+        of each segment, i.e. the segment that would be built from the output of Morph_Decomposer.morph_decompose_CTM_decoding
+        (otherwise an empty list)
+        - tokens, file_names and channels : the lists of the strings interned in the columns of the segments of both levels
+        (with token_ids, file_ids and channel_ids mapping them back to their ids)
+        - source_checksums : the checksums of the CTM documents (or streams of lines) added to the index, in order
         Its main methods are:
-        - index_CTM_document, which takes as input the path to a CTM ASR output file
-        and stores its entries as Speech_entity objects in formatted_speech (it also adds None entries to represent silences of >0.5s),
-        as well as creating a dictionary indexing the location of each word in the file, and storing it in occurence_index
+        - index_CTM_document, which takes as input the path to a CTM ASR output file (and optionally a Morph_Decomposer
+        whose decomposition mappings have been loaded) and stores its entries in a single segment (it also adds silence
+        rows to represent silences of >0.5s), as well as creating the posting lists indexing the location of each word in the file
+        With a Morph_Decomposer, the morph-level segment is built in the same pass over the CTM file, out of the same parsed
+        timings and posteriors (decomposed words get the durations and posteriors given by the Morph_Decomposer)
+        - append_CTM_document and append_CTM_lines, which add the entries of a new CTM document (or of an iterable of CTM lines)
+        to the index as a new segment, without touching the existing ones (so that their cost only depends on the size of the new data),
+        remove_file, which marks the entries of a file as removed in every segment (segments that no longer contain
+        any live entry are dropped), replace_file, which removes a file and appends new entries, and compact, which rewrites
+        all the live entries into a single segment
+        - get_occurence_index, which returns a dictionary where each word is mapped to the list of indices of the rows
+        (of the concatenation of the segments) where it occurs (example: occurence_index["abandon"]=[2, 36])
+        - find_phrases, which takes as input a list of queries (lists of tokens), and returns for each of them the list of
+        (segment, array of rows where the query starts) pairs, evaluating the whole list as one batch (see Speech_columns.find_phrases)
         - perform_KWS, which takes as input the path to a XML file which is a list of queries and the path to the desired output file,
         and creates a XML file at that location which contains the list of hits
-        corresponding to the queries and the current content of formatted_speech and occurence_index
+        corresponding to the queries and the current content of the segments, along with the time spent on each query
+        and the number of its tokens that do not occur in the live entries of the level searched (search_time and oov_count,
+        which are also recorded by the current instrumentation, see Instrumentation)
+        (the files are streamed with XML_list_reader and XML_list_writer, and the queries searched by batches of batch_size)
+        With top_k and/or min_score, only the top_k hits of highest score of each query and/or the hits of score at least min_score
+        are output, the scores being accumulated in log space during the search so that the hopeless partial matches are dropped
+        early (see search_scored_hits)
+        With level="morph", the queries are decomposed in memory by self.morph_decomposer and searched in self.morph_segments
+        - build_neighbor_table, which stores in self.neighbor_tables[level] a Neighbor_table with the k most confusable other tokens
+        of each token of a level (under the grapheme confusion scores of a Grapheme_Based_Mapper), and perform_fuzzy_KWS, which does
+        the same as perform_KWS except that each query token also matches its neighbors (one posting list per neighbor is merged,
+        so that no vocabulary is scanned at query time), the score of a hit being the product of its posteriors and of the
+        confusion weights of the neighbors it matched (see find_scored_phrases); load_or_build_neighbor_table saves the table to a separate file
+        and only rebuilds it when the .map or .dct file, k or the tokens of the level change
+        (the table is not updated when entries are appended to the index: the neighbors of the query tokens that have no entry in the table,
+        including the ones that are not in the index, are searched at query time, see search_token_candidates)
+        - save and load, which write the index to a binary file (see write_array_file) and reopen it memory-mapped;
+        the file contains INDEX_FILE_VERSION, self.source_checksums and the checksum of the decomposition mapping (if any),
+        so that load_or_index_CTM_document only rebuilds (and saves) the index when the file is missing or stale
         """
         def __init__(self):
-                self.formatted_speech=[]
-                self.occurence_index=dict()
-
-        def get_occurence_index(self):
-                return self.occurence_index
-        
-        def index_CTM_document(self,path_to_CTM_document):
-                self.formatted_speech=[]
-                self.occurence_index=dict()
-                for line in open(path_to_CTM_document,"r"):
-                        entry = Speech_entity(line)
-                        if self.formatted_speech!=[] and (entry.tbeg - self.formatted_speech[-1].tend >0.5 ) :
-                                self.formatted_speech.append(None)
-                        self.formatted_speech.append(entry)
-                        if self.occurence_index.get(entry.token) != None:
-                                self.occurence_index[entry.token].append(len(self.formatted_speech)-1)
+                self.sharding_index_file = None
+                self.clear()
+
+        def clear(self):
+                self.tokens=[]
+                self.token_ids=dict()
+                self.file_names=[]
+                self.file_ids=dict()
+                self.channels=[]
+                self.channel_ids=dict()
+                self.segments=[]
+                self.morph_segments=[]
+                self.morph_decomposer=None
+                self.source_checksums=[]
+                self.neighbor_tables=dict()
+
+        def get_segments(self,level="word"):
+                if level == "word":
+                        return self.segments
+                elif level == "morph":
+                        return self.morph_segments
+                raise ValueError("level must be either \"word\" or \"morph\"")
+
+        def get_occurence_index(self,level="word"):
+                occurence_index = dict()
+                segment_start = 0
+                for segment in self.get_segments(level):
+                        live_postings = segment.postings[segment.get_live_rows()[segment.postings]]
+                        live_tokens = segment.token_column[live_postings]
+                        for token_id in np.unique(live_tokens):
+                                occurence_index.setdefault(self.tokens[token_id],[]).extend((segment_start + live_postings[live_tokens == token_id]).tolist())
+                        segment_start += len(segment)
+                return occurence_index
+
+        def intern(self,string,ids,strings):
+                if string not in ids:
+                        ids[string] = len(strings)
+                        strings.append(string)
+                return ids[string]
+
+        def parse_CTM_lines(self,lines):
+                # returns the word-level segment and (if self.morph_decomposer is set) the morph-level segment of lines
+                token_column, file_column, channel_column, tbeg, tdur, posterior = [], [], [], [], [], []
+                for line in lines:
+                        split_entry=line.split()
+                        file_column.append(self.intern(split_entry[0],self.file_ids,self.file_names))
+                        channel_column.append(self.intern(split_entry[1],self.channel_ids,self.channels))
+                        tbeg.append(float(split_entry[2]))
+                        tdur.append(float(split_entry[3]))
+                        token_column.append(self.intern(split_entry[4].lower(),self.token_ids,self.tokens))
+                        posterior.append(float(split_entry[5]))
+                get_instrumentation().increment("index.CTM_lines",len(token_column))
+                if self.morph_decomposer is None:
+                        return self.build_speech_columns(token_column,file_column,channel_column,tbeg,tdur,posterior), None
+                morph_columns = self.decompose_columns(token_column,file_column,channel_column,tbeg,tdur,posterior)
+                return self.build_speech_columns(token_column,file_column,channel_column,tbeg,tdur,posterior), self.build_speech_columns(*morph_columns)
+
+        def decompose_columns(self,token_column,file_column,channel_column,tbeg,tdur,posterior):
+                # same entries as the ones written by Morph_Decomposer.morph_decompose_CTM_decoding (and read back by parse_CTM_lines)
+                mapping = self.morph_decomposer.decomposition_mapping_decoded_speech
+                subword_ids = dict()
+                for token_id in OrderedDict.fromkeys(token_column):
+                        token = self.tokens[token_id]
+                        if token in mapping:
+                                subword_ids[token_id] = [self.intern(subword.lower(),self.token_ids,self.tokens) for subword in mapping[token]]
+                morph_token_column = []
+                n = np.ones(len(token_column),dtype=np.int64)
+                for entry_index, token_id in enumerate(token_column):
+                        if token_id in subword_ids:
+                                morph_token_column.extend(subword_ids[token_id])
+                                n[entry_index] = len(subword_ids[token_id])
+                        else:
+                                morph_token_column.append(token_id)
+                decomposed = np.array([token_id in subword_ids for token_id in token_column],dtype=bool)
+                tbeg = np.asarray(tbeg,dtype=np.float64)
+                tdur = np.asarray(tdur,dtype=np.float64)
+                posterior = np.asarray(posterior,dtype=np.float64)
+                decomposed_duration = np.where(decomposed,np.round(tdur/n,2),tdur)
+                decomposed_posterior = posterior.copy()
+                for entry_index in np.flatnonzero(decomposed):
+                        decomposed_posterior[entry_index] = float(self.morph_decomposer.get_decomposed_posterior(posterior[entry_index],int(n[entry_index])))
+                subword_index = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n,n)
+                return (morph_token_column,np.repeat(np.asarray(file_column,dtype=np.int32),n),np.repeat(np.asarray(channel_column,dtype=np.int32),n),
+                        np.repeat(tbeg,n) + subword_index*np.repeat(decomposed_duration,n),np.repeat(decomposed_duration,n),np.repeat(decomposed_posterior,n))
+
+        def build_speech_columns(self,token_column,file_column,channel_column,tbeg,tdur,posterior,block_starts=None):
+                # builds a segment out of consecutive entries (without silence rows), block_starts marking the entries
+                # that must not be part of the same phrase as the previous entry
+                file_column = np.asarray(file_column,dtype=np.int32)
+                channel_column = np.asarray(channel_column,dtype=np.int32)
+                tbeg = np.asarray(tbeg,dtype=np.float64)
+                tdur = np.asarray(tdur,dtype=np.float64)
+                # a silence row is inserted before every entry that starts more than 0.5s after the end of the previous one,
+                # or that does not belong to the same file and channel as the previous one
+                breaks = np.zeros(len(tbeg),dtype=bool)
+                breaks[1:] = (tbeg[1:] - (tbeg[:-1] + tdur[:-1]) > 0.5) | (file_column[1:] != file_column[:-1]) | (channel_column[1:] != channel_column[:-1])
+                if block_starts is not None:
+                        breaks[1:] |= block_starts[1:]
+                rows = np.arange(len(tbeg)) + np.cumsum(breaks)
+                n_rows = len(tbeg) + int(breaks.sum())
+                columns = []
+                for values, dtype, silence_value in [(token_column,np.int32,-1),(file_column,np.int32,-1),(channel_column,np.int32,-1),(tbeg,np.float64,0),(tdur,np.float64,0),(posterior,np.float64,0)]:
+                        column = np.full(n_rows,silence_value,dtype=dtype)
+                        column[rows] = values
+                        columns.append(column)
+                speech = Speech_columns(*columns)
+                speech.build_postings(len(self.tokens))
+                return speech
+
+        def index_CTM_document(self,path_to_CTM_document,morph_decomposer=None):
+                with get_instrumentation().timer("index.indexing"):
+                        self.clear()
+                        self.morph_decomposer = morph_decomposer
+                        self.append_CTM_document(path_to_CTM_document)
+
+        def append_CTM_document(self,path_to_CTM_document):
+                with open(path_to_CTM_document,"r") as f:
+                        self.append_CTM_lines(f,file_checksum(path_to_CTM_document))
+
+        def append_CTM_lines(self,lines,source_checksum=None):
+                # lines is an iterable of CTM lines (for example an open CTM file)
+                if source_checksum is None:
+                        checksum = hashlib.sha1()
+                        lines = list(lines)
+                        for line in lines:
+                                checksum.update(line.encode("utf-8"))
+                        source_checksum = checksum.hexdigest()
+                segment, morph_segment = self.parse_CTM_lines(lines)
+                if len(segment) != 0:
+                        self.segments.append(segment)
+                        if morph_segment is not None:
+                                self.morph_segments.append(morph_segment)
+                self.source_checksums.append(source_checksum)
+
+        def remove_file(self,file_name):
+                file_id = self.file_ids.get(file_name)
+                if file_id is None:
+                        return
+                for segment in self.segments + self.morph_segments:
+                        if file_id in segment.file_ids_present:
+                                segment.removed_file_ids.add(file_id)
+                self.segments = [segment for segment in self.segments if len(segment.removed_file_ids) < len(segment.file_ids_present)]
+                self.morph_segments = [segment for segment in self.morph_segments if len(segment.removed_file_ids) < len(segment.file_ids_present)]
+                self.source_checksums.append("removed " + file_name)
+
+        def replace_file(self,file_name,lines,source_checksum=None):
+                # lines are the new CTM lines of the file (they may also contain entries of other files)
+                self.remove_file(file_name)
+                self.append_CTM_lines(lines,source_checksum)
+
+        def compact(self):
+                if len(self.segments) <= 1 and all(len(segment.removed_file_ids) == 0 for segment in self.segments):
+                        return
+                self.segments = self.compact_segments(self.segments)
+                if self.morph_decomposer is not None:
+                        self.morph_segments = self.compact_segments(self.morph_segments)
+
+        def compact_segments(self,segments):
+                values = dict((name,[]) for name in SPEECH_COLUMNS)
+                block_starts = []
+                for segment in segments:
+                        live_rows = np.flatnonzero(segment.get_live_rows())
+                        for name in SPEECH_COLUMNS:
+                                values[name].append(getattr(segment,name)[live_rows])
+                        segment_starts = np.zeros(len(live_rows),dtype=bool)
+                        segment_starts[:1] = True
+                        block_starts.append(segment_starts)
+                segment = self.build_speech_columns(*[np.concatenate(values[name]) for name in SPEECH_COLUMNS],block_starts=np.concatenate(block_starts))
+                return [segment] if len(segment) != 0 else []
+
+        def get_decomposition_checksum(self):
+                if self.morph_decomposer is None:
+                        return None
+                return hashlib.sha1(json.dumps(sorted(self.morph_decomposer.decomposition_mapping_decoded_speech.items())).encode("utf-8")).hexdigest()
+
+        def save(self,path_to_index_file):
+                header = {"version":INDEX_FILE_VERSION,"source_checksums":self.source_checksums,"decomposition_checksum":self.get_decomposition_checksum(),
+                        "tokens":self.tokens,"file_names":self.file_names,"channels":self.channels,"removed_file_ids":dict()}
+                arrays = OrderedDict()
+                for level in ["word","morph"]:
+                        header["removed_file_ids"][level] = [sorted(int(file_id) for file_id in segment.removed_file_ids) for segment in self.get_segments(level)]
+                        for segment_index, segment in enumerate(self.get_segments(level)):
+                                for name in SPEECH_COLUMNS + ["posting_offsets","postings","file_ids_present"]:
+                                        arrays["%s.segment%d.%s" % (level,segment_index,name)] = getattr(segment,name)
+                write_array_file(path_to_index_file,header,arrays)
+
+        def load(self,path_to_index_file,morph_decomposer=None):
+                # morph_decomposer is used to decompose the queries of morph-level searches
+                header, arrays = read_array_file(path_to_index_file)
+                if header.get("version") != INDEX_FILE_VERSION:
+                        raise ValueError(path_to_index_file + " was written with another version of the index file format")
+                self.tokens = header["tokens"]
+                self.token_ids = dict((token,token_id) for token_id, token in enumerate(self.tokens))
+                self.file_names = header["file_names"]
+                self.file_ids = dict((file_name,file_id) for file_id, file_name in enumerate(self.file_names))
+                self.channels = header["channels"]
+                self.channel_ids = dict((channel,channel_id) for channel_id, channel in enumerate(self.channels))
+                self.segments = []
+                self.morph_segments = []
+                for level in ["word","morph"]:
+                        for segment_index, removed_file_ids in enumerate(header["removed_file_ids"][level]):
+                                segment = Speech_columns(*[arrays["%s.segment%d.%s" % (level,segment_index,name)] for name in SPEECH_COLUMNS])
+                                segment.posting_offsets = arrays["%s.segment%d.posting_offsets" % (level,segment_index)]
+                                segment.postings = arrays["%s.segment%d.postings" % (level,segment_index)]
+                                segment.file_ids_present = arrays["%s.segment%d.file_ids_present" % (level,segment_index)]
+                                segment.removed_file_ids = set(removed_file_ids)
+                                self.get_segments(level).append(segment)
+                self.morph_decomposer = morph_decomposer
+                self.source_checksums = header["source_checksums"]
+                self.neighbor_tables = dict()
+
+        def load_or_index_CTM_document(self,path_to_CTM_document,path_to_index_file,morph_decomposer=None):
+                # returns True if the index had to be (re)built from the CTM file
+                self.morph_decomposer = morph_decomposer
+                if os.path.exists(path_to_index_file):
+                        try:
+                                header = read_array_file(path_to_index_file)[0]
+                        except ValueError:
+                                header = dict()
+                        if header.get("version") == INDEX_FILE_VERSION and header.get("source_checksums") == [file_checksum(path_to_CTM_document)] and header.get("decomposition_checksum") == self.get_decomposition_checksum():
+                                self.load(path_to_index_file,morph_decomposer)
+                                return False
+                self.index_CTM_document(path_to_CTM_document,morph_decomposer)
+                self.save(path_to_index_file)
+                return True
+
+        def get_hit_attributes(self,speech,position,length,log_weight=None):
+                # same values (and string formatting) as the ones computed on the former list of Speech_entity
+                # (the score of a fuzzy match is also weighted by the confusion weight of its tokens)
+                last = position + length - 1
+                total_proba = np.prod(speech.posterior[position:position+length])
+                if log_weight is not None:
+                        total_proba = total_proba * np.exp(log_weight)
+                return OrderedDict([("file", self.file_names[speech.file_column[position]]),("channel" , self.channels[speech.channel_column[position]]),("tbeg" , str(float(speech.tbeg[position]))),("dur",str(np.round((speech.tbeg[last] + speech.tdur[last]) - speech.tbeg[position],2))),("score",str(np.round(total_proba,6))),("decision","YES")])
+
+        def serialize_hits(self,speech,positions,length,escaped_names):
+                # the kw elements of the hits at positions (each one followed by a newline), with the same bytes as the ones written
+                # by perform_KWS for the attributes of get_hit_attributes; escaped_names caches the escaped file names and channels
+                positions = np.asarray(positions,dtype=np.int64)
+                last = positions + length - 1
+                total_probas = speech.posterior[positions]
+                for offset in range(1,length):
+                        total_probas = total_probas * speech.posterior[positions + offset]
+                durations = np.round((speech.tbeg[last] + speech.tdur[last]) - speech.tbeg[positions],2)
+                scores = np.round(total_probas,6)
+                serialized_hits = []
+                for file_id, channel_id, tbeg, duration, score in zip(speech.file_column[positions].tolist(),speech.channel_column[positions].tolist(),speech.tbeg[positions].tolist(),durations.tolist(),scores.tolist()):
+                        file_name = escaped_names.get(("file",file_id))
+                        if file_name is None:
+                                file_name = escaped_names[("file",file_id)] = escape_attribute(self.file_names[file_id])
+                        channel = escaped_names.get(("channel",channel_id))
+                        if channel is None:
+                                channel = escaped_names[("channel",channel_id)] = escape_attribute(self.channels[channel_id])
+                        serialized_hits.append(b'<kw file="%s" channel="%s" tbeg="%s" dur="%s" score="%s" decision="YES" />\n' % (file_name,channel,str(tbeg).encode("us-ascii"),str(duration).encode("us-ascii"),str(score).encode("us-ascii")))
+                return serialized_hits
+
+        def get_query_tokens(self,query_text,level="word"):
+                # tokens searched for the text of a query
+                if level == "morph":
+                        return self.morph_decomposer.decompose_query_words(query_text.split())
+                return query_text.split()
+
+        def find_phrases(self,list_of_query_texts,level="word",query_times=None):
+                # the time spent on each query is added to query_times (if given, with one entry per query)
+                list_of_query_ids = [[self.token_ids.get(token) for token in query_text] for query_text in list_of_query_texts]
+                searchable_queries = [query_index for query_index, query_ids in enumerate(list_of_query_ids) if len(query_ids) != 0 and None not in query_ids]
+                results = [[] for query_ids in list_of_query_ids]
+                searchable_query_times = np.zeros(len(searchable_queries))
+                for segment in self.get_segments(level):
+                        list_of_positions = segment.find_phrases([list_of_query_ids[query_index] for query_index in searchable_queries],searchable_query_times)
+                        for query_index, positions in zip(searchable_queries,list_of_positions):
+                                if len(positions) != 0:
+                                        results[query_index].append((segment,positions))
+                if query_times is not None:
+                        for query_index, query_time in zip(searchable_queries,searchable_query_times):
+                                query_times[query_index] += query_time
+                return results
+
+        def search_hits(self,list_of_query_texts,level="word",top_k=None,min_score=None,query_times=None):
+                # attributes of the kw elements of the hits of each query (a list of tokens), in the order of the output
+                # (see search_scored_hits for top_k and min_score); the time spent on each query is added to query_times (if given)
+                if top_k is not None or min_score is not None:
+                        return self.search_scored_hits(list_of_query_texts,level,False,top_k,min_score,query_times)
+                if query_times is None:
+                        query_times = np.zeros(len(list_of_query_texts))
+                list_of_hits = []
+                for query_index, (query_text, results) in enumerate(zip(list_of_query_texts,self.find_phrases(list_of_query_texts,level,query_times))):
+                        start_time = time.perf_counter()
+                        list_of_hits.append([self.get_hit_attributes(segment,position,len(query_text)) for segment, positions in results for position in positions])
+                        query_times[query_index] += time.perf_counter() - start_time
+                return list_of_hits
+
+        def get_level_token_ids(self,level="word"):
+                # sorted ids of the tokens that occur in the live rows of the segments of the level
+                token_columns = [segment.token_column[segment.get_live_rows()] for segment in self.get_segments(level)]
+                return np.unique(np.concatenate(token_columns)).astype(np.int32) if len(token_columns) != 0 else np.zeros(0,dtype=np.int32)
+
+        def get_level_tokens(self,level="word"):
+                # set of the tokens that occur in the live rows of the segments of the level
+                return set(self.tokens[token_id] for token_id in self.get_level_token_ids(level).tolist())
+
+        def get_tokens_checksum(self,token_ids):
+                return hashlib.sha1(json.dumps([[int(token_id),self.tokens[token_id]] for token_id in token_ids]).encode("utf-8")).hexdigest()
+
+        def build_neighbor_table(self,grapheme_based_mapper,k=5,level="word",n_processes=1):
+                """
+                Finds, for each token of the level (see get_occurence_index), its k most confusable other tokens of the level
+                under the grapheme confusion scores of grapheme_based_mapper (see Grapheme_Based_Mapper.confusable_neighbors,
+                the searches of the tokens can be spread across n_processes processes), and stores them in self.neighbor_tables[level]
+                """
+                token_ids = self.get_level_token_ids(level)
+                level_tokens = [self.tokens[token_id] for token_id in token_ids]
+                list_of_neighbors = grapheme_based_mapper.confusable_neighbors(level_tokens,level_tokens,k,n_processes)
+                counts = np.zeros(len(self.tokens),dtype=np.int64)
+                counts[token_ids] = [len(neighbors) for neighbors in list_of_neighbors]
+                offsets = np.concatenate([[0],np.cumsum(counts)]).astype(np.int64)
+                neighbor_ids = np.array([self.token_ids[neighbor] for neighbors in list_of_neighbors for neighbor, log_weight in neighbors],dtype=np.int32)
+                log_weights = np.array([log_weight for neighbors in list_of_neighbors for neighbor, log_weight in neighbors],dtype=np.float64)
+                header = {"version":NEIGHBOR_TABLE_FILE_VERSION,"level":level,"k":k,"mapper_fingerprint":grapheme_based_mapper.get_fingerprint(),"tokens_checksum":self.get_tokens_checksum(token_ids)}
+                self.neighbor_tables[level] = Neighbor_table(offsets,neighbor_ids,log_weights,header,grapheme_based_mapper)
+
+        def save_neighbor_table(self,path_to_neighbor_file,level="word"):
+                table = self.neighbor_tables[level]
+                write_array_file(path_to_neighbor_file,table.header,OrderedDict([("offsets",table.offsets),("neighbor_ids",table.neighbor_ids),("log_weights",table.log_weights)]))
+
+        def load_neighbor_table(self,path_to_neighbor_file,level="word",grapheme_based_mapper=None):
+                # grapheme_based_mapper (which must be the one the table was built with) is needed to search the neighbors
+                # of the query tokens that have no entry in the table (see search_token_candidates)
+                header, arrays = read_array_file(path_to_neighbor_file)
+                if header.get("version") != NEIGHBOR_TABLE_FILE_VERSION:
+                        raise ValueError(path_to_neighbor_file + " was written with another version of the neighbor table file format")
+                if header.get("level") != level:
+                        raise ValueError(path_to_neighbor_file + " is not a neighbor table of the " + level + " level")
+                if grapheme_based_mapper is not None and header.get("mapper_fingerprint") != grapheme_based_mapper.get_fingerprint():
+                        raise ValueError(path_to_neighbor_file + " was built with another .map or .dct file")
+                del header["arrays"]
+                self.neighbor_tables[level] = Neighbor_table(arrays["offsets"],arrays["neighbor_ids"],arrays["log_weights"],header,grapheme_based_mapper)
+
+        def load_or_build_neighbor_table(self,path_to_neighbor_file,grapheme_based_mapper,k=5,level="word",n_processes=1):
+                # returns True if the table had to be (re)built, i.e. if the file is missing or was built with other parameters,
+                # another .map or .dct file, or other tokens
+                if os.path.exists(path_to_neighbor_file):
+                        try:
+                                header = read_array_file(path_to_neighbor_file)[0]
+                        except ValueError:
+                                header = dict()
+                        if header.get("version") == NEIGHBOR_TABLE_FILE_VERSION and header.get("level") == level and header.get("k") == k and header.get("mapper_fingerprint") == grapheme_based_mapper.get_fingerprint() and header.get("tokens_checksum") == self.get_tokens_checksum(self.get_level_token_ids(level)):
+                                self.load_neighbor_table(path_to_neighbor_file,level,grapheme_based_mapper)
+                                return False
+                self.build_neighbor_table(grapheme_based_mapper,k,level,n_processes)
+                self.save_neighbor_table(path_to_neighbor_file,level)
+                return True
+
+        def search_token_candidates(self,token,level="word"):
+                """
+                Candidates of a token that has no entry in the neighbor table of the level (see Neighbor_table.has_entry): the token itself
+                (if it is in the index) followed by its k most confusable tokens of the level, searched with the Grapheme_Based_Mapper
+                of the table (see Vocabulary_Search_Engine.confusable_neighbors, the log weights being relative to the token itself)
+                The search engine over the tokens of the level is built at the first search, and the candidates of each token are cached in the table
+                Returns None for a token that is not in the index if the table was loaded without a Grapheme_Based_Mapper
+                """
+                table = self.neighbor_tables[level]
+                token_id = self.token_ids.get(token)
+                if (token,token_id) not in table.searched_candidates:
+                        if table.grapheme_based_mapper is None:
+                                return None if token_id is None else (np.array([token_id],dtype=np.int32),np.zeros(1))
+                        if table.search_engine is None:
+                                table.search_engine = table.grapheme_based_mapper.get_vocabulary_search_engine([self.tokens[level_token_id] for level_token_id in self.get_level_token_ids(level)])
+                        neighbors = table.search_engine.confusable_neighbors(token,table.header["k"])
+                        self_candidate = [] if token_id is None else [(token_id,0.0)]
+                        candidates = self_candidate + [(self.token_ids[neighbor],log_weight) for neighbor, log_weight in neighbors]
+                        table.searched_candidates[(token,token_id)] = (np.array([candidate_id for candidate_id, log_weight in candidates],dtype=np.int32),np.array([log_weight for candidate_id, log_weight in candidates],dtype=np.float64))
+                return table.searched_candidates[(token,token_id)]
+
+        def get_query_candidates(self,query_text,level="word",use_neighbors=True):
+                # (ids, log weights) of the candidates of each token of the query, or None if one of them has no candidate
+                # (without use_neighbors or a neighbor table for the level, the only candidate of a token is itself, and a token
+                # that is not in the index has none; see search_token_candidates for the tokens without entry in the table)
+                table = self.neighbor_tables.get(level) if use_neighbors else None
+                query_candidates = []
+                for token in query_text:
+                        token_id = self.token_ids.get(token)
+                        if table is None:
+                                if token_id is None:
+                                        return None
+                                query_candidates.append((np.array([token_id],dtype=np.int32),np.zeros(1)))
+                        elif token_id is not None and table.has_entry(token_id):
+                                query_candidates.append(table.get_candidates(token_id))
                         else:
-                                self.occurence_index[entry.token]= [len(self.formatted_speech)-1]
+                                candidates = self.search_token_candidates(token,level)
+                                if candidates is None or len(candidates[0]) == 0:
+                                        return None
+                                query_candidates.append(candidates)
+                return query_candidates
+
+        def find_scored_phrases(self,list_of_query_texts,level="word",use_neighbors=True,min_score=None,query_times=None):
+                """
+                Same as find_phrases, except that each match also has a log weight and a log score (see Speech_columns.find_weighted_phrases),
+                i.e. returns for each query a list of (segment, positions, log weights, log scores)
+                With use_neighbors, each token is expanded to its confusable neighbors (see build_neighbor_table)
+                With min_score, the matches whose score (product of the posteriors and of the confusion weights) is below min_score
+                are dropped during the search, as soon as their partial score is
+                The time spent on each query is added to query_times (if given), as in find_phrases
+                """
+                min_log_score = None
+                if min_score is not None:
+                        with np.errstate(divide="ignore"):
+                                min_log_score = np.log(min_score)
+                list_of_query_candidates = [self.get_query_candidates(query_text,level,use_neighbors) for query_text in list_of_query_texts]
+                searchable_queries = [query_index for query_index, query_candidates in enumerate(list_of_query_candidates) if query_candidates]
+                results = [[] for query_candidates in list_of_query_candidates]
+                searchable_query_times = np.zeros(len(searchable_queries))
+                for segment in self.get_segments(level):
+                        list_of_matches = segment.find_weighted_phrases([list_of_query_candidates[query_index] for query_index in searchable_queries],min_log_score,searchable_query_times)
+                        for query_index, (positions, log_weights, log_scores) in zip(searchable_queries,list_of_matches):
+                                if len(positions) != 0:
+                                        results[query_index].append((segment,positions,log_weights,log_scores))
+                if query_times is not None:
+                        for query_index, query_time in zip(searchable_queries,searchable_query_times):
+                                query_times[query_index] += query_time
+                return results
+
+        def select_top_matches(self,results,top_k):
+                # keeps the top_k matches of highest log score among the results of a query (see find_scored_phrases),
+                # ties being broken by the order of the output
+                if top_k is None:
+                        return results
+                kept = select_top_scores(np.concatenate([log_scores for segment, positions, log_weights, log_scores in results]) if len(results) != 0 else np.zeros(0),top_k)
+                boundaries = np.cumsum([0]+[len(positions) for segment, positions, log_weights, log_scores in results])
+                selected_results = []
+                for result_index, (segment, positions, log_weights, log_scores) in enumerate(results):
+                        indices = kept[(kept >= boundaries[result_index]) & (kept < boundaries[result_index+1])] - boundaries[result_index]
+                        if len(indices) != 0:
+                                selected_results.append((segment,positions[indices],log_weights[indices],log_scores[indices]))
+                return selected_results
+
+        def search_scored_hits(self,list_of_query_texts,level="word",use_neighbors=True,top_k=None,min_score=None,query_times=None):
+                """
+                Attributes of the kw elements of the hits of each query, where only the hits of score at least min_score (if given),
+                and among them the top_k hits of highest score (if given), are kept (in the order of the output)
+                The scores are computed in log space and accumulated along the phrase, so that the search drops the partial matches
+                that cannot reach min_score anymore, and only the attributes of the remaining hits are formatted
+                (the score written for a kept hit is the same as without pruning)
+                The time spent on each query is added to query_times (if given)
+                """
+                if query_times is None:
+                        query_times = np.zeros(len(list_of_query_texts))
+                list_of_hits = []
+                for query_index, (query_text, results) in enumerate(zip(list_of_query_texts,self.find_scored_phrases(list_of_query_texts,level,use_neighbors,min_score,query_times))):
+                        start_time = time.perf_counter()
+                        results = self.select_top_matches(results,top_k)
+                        list_of_hits.append([self.get_hit_attributes(segment,position,len(query_text),log_weight if use_neighbors else None) for segment, positions, log_weights, log_scores in results for position, log_weight in zip(positions,log_weights)])
+                        query_times[query_index] += time.perf_counter() - start_time
+                return list_of_hits
+
+        def search_fuzzy_hits(self,list_of_query_texts,level="word",top_k=None,min_score=None,query_times=None):
+                return self.search_scored_hits(list_of_query_texts,level,True,top_k,min_score,query_times)
+
+        def perform_fuzzy_KWS(self,path_to_XML_query_list,path_to_XML_output,level="word",batch_size=1000,top_k=None,min_score=None):
+                self.write_KWS_output(path_to_XML_query_list,path_to_XML_output,lambda list_of_query_texts, query_times: self.search_fuzzy_hits(list_of_query_texts,level,top_k,min_score,query_times),level,batch_size)
+
+        def perform_KWS(self,path_to_XML_query_list,path_to_XML_output,level="word",batch_size=1000,top_k=None,min_score=None):
+                self.write_KWS_output(path_to_XML_query_list,path_to_XML_output,lambda list_of_query_texts, query_times: self.search_hits(list_of_query_texts,level,top_k,min_score,query_times),level,batch_size)
 
+        def write_KWS_output(self,path_to_XML_query_list,path_to_XML_output,search,level="word",batch_size=1000):
+                # the query list is read and the list of hits written incrementally, batch_size queries at a time,
+                # search returning the attributes of the hits of a batch of queries (see search_hits), or their Serialized_hits,
+                # and adding the time spent on each query to its second argument
+                with get_instrumentation().timer("index.KWS"):
+                        self.stream_KWS_output(path_to_XML_query_list,path_to_XML_output,search,level,batch_size)
 
-        def perform_KWS(self,path_to_XML_query_list,path_to_XML_output):
-                tree=ET.parse(path_to_XML_query_list)
-                root = tree.getroot()
-                for kw in root:
+        def stream_KWS_output(self,path_to_XML_query_list,path_to_XML_output,search,level="word",batch_size=1000):
+                reader = XML_list_reader(path_to_XML_query_list)
+                writer = None
+                batch = []
+                level_tokens = self.get_level_tokens(level)
+                for kw in reader:
+                        if writer is None:
+                                writer = self.open_kwslist_writer(reader.root,path_to_XML_output)
+                        batch.append(kw)
+                        if len(batch) == batch_size:
+                                self.write_detected_kwlists(batch,writer,search,level,level_tokens)
+                                batch = []
+                if writer is None:
+                        writer = self.open_kwslist_writer(reader.root,path_to_XML_output)
+                self.write_detected_kwlists(batch,writer,search,level,level_tokens)
+                writer.close()
+
+        def open_kwslist_writer(self,root,path_to_XML_output):
+                del root.attrib["ecf_filename"],root.attrib["language"], root.attrib["encoding"], root.attrib["compareNormalize"], root.attrib["version"]
+                return XML_list_writer(path_to_XML_output,"kwslist",OrderedDict([("kwlist_filename","IARPA-babel202b-v1.0d_conv-dev.kwlist.xml"),("language","swahili"),("system_id","")]),root.text)
+
+        def write_detected_kwlists(self,list_of_kw,writer,search,level="word",level_tokens=None):
+                # search_time is the time spent on the query (in seconds) and oov_count the number of its tokens that are not
+                # in level_tokens (the tokens of the live entries of the level, see get_level_tokens)
+                if level_tokens is None:
+                        level_tokens = self.get_level_tokens(level)
+                list_of_query_texts = [self.get_query_tokens(kw[0].text,level) for kw in list_of_kw]
+                query_times = np.zeros(len(list_of_kw))
+                instrumentation = get_instrumentation()
+                list_of_hits = search(list_of_query_texts,query_times)
+                for kw, query_text, query_time, list_of_hit_attributes in zip(list_of_kw,list_of_query_texts,query_times,list_of_hits):
+                        oov_count = sum(1 for token in query_text if token not in level_tokens)
+                        instrumentation.record_query(kw.attrib.get("kwid"),kw[0].text,float(query_time),oov_count,len(list_of_hit_attributes))
                         kw.tag = "detected_kwlist"
-                        kw.attrib["oov_count"]="0"
-                        kw.attrib["search_time"]= "0.0"
-                        query_text=kw[0].text.split()
+                        kw.attrib["oov_count"]=str(oov_count)
+                        kw.attrib["search_time"]= str(np.round(query_time,6))
                         kw.remove(kw[0])
-                        if self.occurence_index.get(query_text[0]) != None:
-                                for partial_hit in self.occurence_index[query_text[0]]:
-                                        possible_hit = self.formatted_speech[partial_hit:partial_hit+len(query_text)]
-                                        tokens_in_file = [entry.token if entry!= None else None for entry in possible_hit]
-                                        if tokens_in_file == query_text:
-                                                hit = ET.SubElement(kw, "kw")
-                                                total_proba = np.prod([entry.posterior if entry!= None else 0 for entry in possible_hit])
-                                                hit.attrib = OrderedDict([("file", possible_hit[0].file_name),("channel" , possible_hit[0].channel),("tbeg" , str(possible_hit[0].tbeg)),("dur",str(np.round(possible_hit[-1].tend - possible_hit[0].tbeg,2))),("score",str(np.round(total_proba,6))),("decision","YES")])
-                                                # possible indentation problems
-                                                hit.tail = "\n"
-                root.tag = "kwslist"
-                del root.attrib["ecf_filename"],root.attrib["language"], root.attrib["encoding"], root.attrib["compareNormalize"], root.attrib["version"]
-                root.attrib = OrderedDict([("kwlist_filename","IARPA-babel202b-v1.0d_conv-dev.kwlist.xml"),("language","swahili"),("system_id","")])
-                tree.write(path_to_XML_output)
\ No newline at end of file
+                        if isinstance(list_of_hit_attributes,Serialized_hits):
+                                writer.write_child(kw,list_of_hit_attributes.content)
+                                continue
+                        for hit_attributes in list_of_hit_attributes:
+                                hit = ET.SubElement(kw, "kw")
+                                hit.attrib = hit_attributes
+                                # possible indentation problems
+                                hit.tail = "\n"
+                        writer.write_child(kw)
+
+        def partition_files(self,n_shards):
+                # splits the files of the index into n_shards lists of file ids with similar numbers of entries
+                # (largest files first, each one going to the shard with the fewest entries so far)
+                n_entries = np.zeros(len(self.file_names),dtype=np.int64)
+                for segment in self.segments:
+                        live_rows = segment.get_live_rows()
+                        n_entries += np.bincount(segment.file_column[live_rows],minlength=len(self.file_names))
+                shards = [[] for shard_index in range(n_shards)]
+                shard_sizes = np.zeros(n_shards,dtype=np.int64)
+                for file_id in np.argsort(-n_entries,kind="stable"):
+                        if n_entries[file_id] == 0:
+                                break
+                        shard_index = int(np.argmin(shard_sizes))
+                        shards[shard_index].append(int(file_id))
+                        shard_sizes[shard_index] += n_entries[file_id]
+                return [sorted(shard) for shard in shards if len(shard) != 0]
+
+        def get_shard(self,file_ids):
+                """
+                Returns an Index restricted to the entries of the files of ids file_ids, which shares the interned strings of this index
+                Each segment keeps its rows (so that positions are the same as in this index), the tokens of the other files being
+                replaced by silences, and only the postings of the shard are rebuilt
+                """
+                shard = Index()
+                shard.tokens, shard.token_ids = self.tokens, self.token_ids
+                shard.file_names, shard.file_ids = self.file_names, self.file_ids
+                shard.channels, shard.channel_ids = self.channels, self.channel_ids
+                shard.segments = [segment.restrict_to_files(file_ids,len(self.tokens)) for segment in self.segments]
+                shard.morph_segments = [segment.restrict_to_files(file_ids,len(self.tokens)) for segment in self.morph_segments]
+                shard.morph_decomposer = self.morph_decomposer
+                shard.source_checksums = self.source_checksums
+                return shard
+
+        def get_sharding_index_file(self):
+                # path to a temporary copy of the index, which is only saved again once entries have been added, removed or compacted,
+                # and is removed when the index is garbage collected (or at exit)
+                state = (list(self.source_checksums),[len(segment) for segment in self.segments + self.morph_segments])
+                if self.sharding_index_file is not None:
+                        if self.sharding_index_file[0] == state:
+                                return self.sharding_index_file[1]
+                        self.sharding_index_file[2]()
+                        self.sharding_index_file = None
+                file_descriptor, path_to_index_file = tempfile.mkstemp(suffix=".index")
+                os.close(file_descriptor)
+                remove_index_file = weakref.finalize(self,os.remove,path_to_index_file)
+                self.save(path_to_index_file)
+                self.sharding_index_file = (state,path_to_index_file,remove_index_file)
+                return path_to_index_file
+
+        def perform_KWS_sharded(self,path_to_XML_query_list,path_to_XML_output,n_shards,path_to_index_file=None,level="word",batch_size=1000,top_k=None,min_score=None):
+                """
+                Same output as perform_KWS, with the files of the index partitioned into n_shards shards (see partition_files)
+                that are built (see get_shard) and searched in n_shards worker processes
+                The workers memory-map the index file path_to_index_file (which must contain this index, as written by save,
+                a ValueError being raised if its source checksums are not the ones of this index), or a temporary copy of the index
+                if it is None (see get_sharding_index_file)
+                Each worker returns the segment index, row and log score of its hits as arrays, along with their kw elements
+                already serialized (see serialize_hits); the hits of the shards are merged back in the order of the rows of the index,
+                so that the output does not depend on the partition (except for the search times, which are the sums of the times
+                spent on the query in each shard)
+                With top_k, each shard returns its own top_k hits, and the top_k of their union are kept (see search_scored_hits)
+                """
+                if path_to_index_file is None:
+                        path_to_index_file = self.get_sharding_index_file()
+                elif read_array_file(path_to_index_file)[0].get("source_checksums") != self.source_checksums:
+                        raise ValueError(path_to_index_file + " does not contain this index")
+                reader = XML_list_reader(path_to_XML_query_list)
+                list_of_query_texts = [self.get_query_tokens(kw[0].text,level) for kw in reader]
+                shards = self.partition_files(n_shards)
+                with Pool(max(1,len(shards)),initializer=_initialize_worker_index,initargs=(path_to_index_file,)) as pool:
+                        shard_results = pool.map(_worker_search_shard,[(file_ids,list_of_query_texts,level,top_k,min_score) for file_ids in shards])
+                n_queries = len(list_of_query_texts)
+                merged_query_times = np.sum([shard_result[-1] for shard_result in shard_results],axis=0) if len(shard_results) != 0 else np.zeros(n_queries)
+                # the hits of all the shards (and the byte ranges of their kw elements in the concatenation of the serialized hits),
+                # sorted by (query, segment index, row), which is the order of perform_KWS
+                def concatenate(arrays,dtype):
+                        return np.concatenate([np.asarray(array,dtype=dtype) for array in arrays] + [np.zeros(0,dtype=dtype)])
+                query_column = concatenate([np.repeat(np.arange(n_queries),np.diff(shard_result[0])) for shard_result in shard_results],np.int64)
+                segment_indices = concatenate([shard_result[1] for shard_result in shard_results],np.int64)
+                positions = concatenate([shard_result[2] for shard_result in shard_results],np.int64)
+                log_scores = concatenate([shard_result[3] for shard_result in shard_results],np.float64)
+                content_starts = np.cumsum([0] + [len(shard_result[5]) for shard_result in shard_results])
+                hit_starts = concatenate([shard_result[4][:-1] + content_start for shard_result, content_start in zip(shard_results,content_starts)],np.int64)
+                hit_ends = concatenate([shard_result[4][1:] + content_start for shard_result, content_start in zip(shard_results,content_starts)],np.int64)
+                content = b"".join(shard_result[5] for shard_result in shard_results)
+                order = np.lexsort((positions,segment_indices,query_column))
+                query_offsets = np.searchsorted(query_column[order],np.arange(n_queries + 1))
+                merged_queries = iter(range(n_queries))
+                def search(list_of_query_texts,query_times):
+                        list_of_hits = []
+                        for query_index in range(len(list_of_query_texts)):
+                                merged_query_index = next(merged_queries)
+                                query_times[query_index] += merged_query_times[merged_query_index]
+                                hits = order[query_offsets[merged_query_index]:query_offsets[merged_query_index+1]]
+                                hits = hits[select_top_scores(log_scores[hits],top_k)]
+                                list_of_hits.append(Serialized_hits(b"".join([content[hit_start:hit_end] for hit_start, hit_end in zip(hit_starts[hits].tolist(),hit_ends[hits].tolist())]),len(hits)))
+                        return list_of_hits
+                self.write_KWS_output(path_to_XML_query_list,path_to_XML_output,search,level,batch_size)
+
+
+# index of the worker processes of Index.perform_KWS_sharded
+_worker_index = None
+
+def _initialize_worker_index(path_to_index_file):
+        global _worker_index
+        _worker_index = Index()
+        _worker_index.load(path_to_index_file)
+
+def _worker_search_shard(task):
+        # returns the hits of the shard as arrays: the hits of the i-th query are the ones of indices query_offsets[i] to query_offsets[i+1],
+        # and the kw element of the j-th hit is content[hit_offsets[j]:hit_offsets[j+1]]
+        file_ids, list_of_query_texts, level, top_k, min_score = task
+        shard = _worker_index.get_shard(file_ids)
+        segment_indices = dict((id(segment),segment_index) for segment_index, segment in enumerate(shard.get_segments(level)))
+        query_times = np.zeros(len(list_of_query_texts))
+        if top_k is None and min_score is None:
+                list_of_results = [[(segment,positions,None,np.zeros(len(positions))) for segment, positions in results] for results in shard.find_phrases(list_of_query_texts,level,query_times)]
+        else:
+                list_of_results = shard.find_scored_phrases(list_of_query_texts,level,False,min_score,query_times)
+        query_offsets = [0]
+        hit_segment_indices, hit_positions, hit_log_scores, serialized_hits = [], [], [], []
+        escaped_names = dict()
+        for query_index, (query_text, results) in enumerate(zip(list_of_query_texts,list_of_results)):
+                start_time = time.perf_counter()
+                for segment, positions, log_weights, log_scores in shard.select_top_matches(results,top_k):
+                        hit_segment_indices.append(np.full(len(positions),segment_indices[id(segment)],dtype=np.int32))
+                        hit_positions.append(np.asarray(positions,dtype=np.int64))
+                        hit_log_scores.append(np.asarray(log_scores,dtype=np.float64))
+                        serialized_hits.extend(shard.serialize_hits(segment,positions,len(query_text),escaped_names))
+                query_offsets.append(len(serialized_hits))
+                query_times[query_index] += time.perf_counter() - start_time
+        hit_offsets = np.cumsum([0] + [len(serialized_hit) for serialized_hit in serialized_hits]).astype(np.int64)
+        return (np.array(query_offsets,dtype=np.int64),np.concatenate(hit_segment_indices + [np.zeros(0,dtype=np.int32)]),np.concatenate(hit_positions + [np.zeros(0,dtype=np.int64)]),
+                np.concatenate(hit_log_scores + [np.zeros(0)]),hit_offsets,b"".join(serialized_hits),query_times)
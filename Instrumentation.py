@@ -0,0 +1,173 @@
+import json
+import os
+import sys
+import threading
+import time
+import numpy as np
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+
+
+class Null_Instrumentation():
+        """
+        Instrumentation that records nothing, installed by default so that the instrumented code only pays for a method call
+        (see Instrumentation for the interface)
+        """
+        enabled = False
+
+        def increment(self,name,value=1):
+                pass
+
+        def add_time(self,name,elapsed_time):
+                pass
+
+        @contextmanager
+        def timer(self,name):
+                yield
+
+        def record_query(self,kwid,query_text,search_time,oov_count,n_hits):
+                pass
+
+
+class Instrumentation(Null_Instrumentation):
+        """
+        Collects statistics on where time and work go in a run of the pipeline
+        - self.counters maps a name ("module.quantity", e.g. "index.postings_scanned") to a number incremented by increment(name,value)
+        - self.timers maps a name to [total time, number of measurements, longest measurement]; timer(name) is a context manager
+        that measures the time spent in its block, and add_time(name,elapsed_time) adds a measurement taken elsewhere
+        - self.queries lists (kwid, query text, search time, oov count, number of hits) for each query written by Index.perform_KWS
+        - start_sampling(interval) starts a sampling profiler: a thread that records, every interval seconds, the function being
+        executed by the thread that called start_sampling, along with its callers (self.leaf_samples and self.stack_samples count
+        the samples of each "file:function"); each sampled frame is also passed to self.sampling_hook, if set; stop_sampling stops it
+        (sampling() does both around a block)
+        - get_report returns all of this as a dictionary (with the n_slowest_queries slowest queries and the n_top_functions
+        most sampled functions), which write_report writes as JSON
+        The instrumentation of the modules goes through get_instrumentation(), so that a subclass with other counters, timers or
+        outputs can be plugged in with set_instrumentation; the work of the worker processes of the multi-process methods is not counted
+        """
+        enabled = True
+
+        def __init__(self,sampling_hook=None):
+                self.sampling_hook = sampling_hook
+                self.sampler = None
+                self.reset()
+
+        def reset(self):
+                self.counters = Counter()
+                self.timers = dict()
+                self.queries = []
+                self.leaf_samples = Counter()
+                self.stack_samples = Counter()
+                self.n_samples = 0
+
+        def increment(self,name,value=1):
+                self.counters[name] += value
+
+        def add_time(self,name,elapsed_time):
+                timer = self.timers.setdefault(name,[0.0,0,0.0])
+                timer[0] += elapsed_time
+                timer[1] += 1
+                timer[2] = max(timer[2],elapsed_time)
+
+        @contextmanager
+        def timer(self,name):
+                start_time = time.perf_counter()
+                try:
+                        yield
+                finally:
+                        self.add_time(name,time.perf_counter() - start_time)
+
+        def record_query(self,kwid,query_text,search_time,oov_count,n_hits):
+                self.queries.append((kwid,query_text,search_time,oov_count,n_hits))
+
+        def start_sampling(self,interval=0.005):
+                if self.sampler is not None:
+                        return
+                target_thread_id = threading.get_ident()
+                stop_event = threading.Event()
+                def sample():
+                        while not stop_event.wait(interval):
+                                frame = sys._current_frames().get(target_thread_id)
+                                if frame is not None:
+                                        self.record_sample(frame)
+                thread = threading.Thread(target=sample,daemon=True)
+                self.sampler = (thread,stop_event)
+                thread.start()
+
+        def stop_sampling(self):
+                if self.sampler is None:
+                        return
+                thread, stop_event = self.sampler
+                stop_event.set()
+                thread.join()
+                self.sampler = None
+
+        @contextmanager
+        def sampling(self,interval=0.005):
+                self.start_sampling(interval)
+                try:
+                        yield
+                finally:
+                        self.stop_sampling()
+
+        def record_sample(self,frame):
+                self.n_samples += 1
+                self.leaf_samples[get_frame_name(frame)] += 1
+                # each function of the stack is counted once, even if it is recursive
+                stack = set()
+                caller = frame
+                while caller is not None:
+                        stack.add(get_frame_name(caller))
+                        caller = caller.f_back
+                self.stack_samples.update(stack)
+                if self.sampling_hook is not None:
+                        self.sampling_hook(frame)
+
+        def get_report(self,n_slowest_queries=20,n_top_functions=20):
+                report = OrderedDict()
+                report["counters"] = OrderedDict(sorted(self.counters.items()))
+                report["timers"] = OrderedDict((name,OrderedDict([("total",total),("count",count),("mean",total/count),("max",longest)])) for name, (total, count, longest) in sorted(self.timers.items()))
+                search_times = np.array([query[2] for query in self.queries])
+                report["queries"] = OrderedDict([("count",len(self.queries)),("total_search_time",float(search_times.sum())),
+                        ("oov_count",int(sum(query[3] for query in self.queries))),("n_hits",int(sum(query[4] for query in self.queries)))])
+                if len(self.queries) != 0:
+                        for percentile in [50,90,99]:
+                                report["queries"]["p%d_search_time" % percentile] = float(np.percentile(search_times,percentile))
+                        slowest_queries = sorted(self.queries,key=lambda query: -query[2])[:n_slowest_queries]
+                        report["queries"]["slowest"] = [OrderedDict(zip(["kwid","query","search_time","oov_count","n_hits"],query)) for query in slowest_queries]
+                if self.n_samples != 0:
+                        report["profile"] = OrderedDict([("n_samples",self.n_samples),
+                                ("self",[(name,count/self.n_samples) for name, count in self.leaf_samples.most_common(n_top_functions)]),
+                                ("cumulative",[(name,count/self.n_samples) for name, count in self.stack_samples.most_common(n_top_functions)])])
+                return report
+
+        def write_report(self,path_to_report_file,n_slowest_queries=20,n_top_functions=20):
+                with open(path_to_report_file,"w") as f:
+                        json.dump(self.get_report(n_slowest_queries,n_top_functions),f,indent=2)
+
+
+def get_frame_name(frame):
+        return "%s:%s" % (os.path.basename(frame.f_code.co_filename),frame.f_code.co_name)
+
+
+_instrumentation = Null_Instrumentation()
+
+def get_instrumentation():
+        return _instrumentation
+
+def set_instrumentation(instrumentation):
+        # installs instrumentation (None to disable it) for the whole process, and returns the previous one
+        global _instrumentation
+        previous_instrumentation = _instrumentation
+        _instrumentation = Null_Instrumentation() if instrumentation is None else instrumentation
+        return previous_instrumentation
+
+@contextmanager
+def instrumented(instrumentation=None):
+        # installs instrumentation (a new Instrumentation by default) for the duration of a block, and yields it
+        instrumentation = Instrumentation() if instrumentation is None else instrumentation
+        previous_instrumentation = set_instrumentation(instrumentation)
+        try:
+                yield instrumentation
+        finally:
+                set_instrumentation(previous_instrumentation)
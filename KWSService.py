@@ -0,0 +1,293 @@
+import asyncio
+import json
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# maximal length (in bytes) of a line of the protocol (the answer to a frequent query can list many hits)
+LINE_LIMIT = 1<<28
+
+class KWS_Service():
+        """
+        Resident keyword search service: keeps an Index (and optionally a Grapheme_Based_Mapper whose vocabulary and
+        confusion matrix have been loaded) in memory, and answers queries received over a local socket
+        The protocol is one JSON object per line in both directions:
+        - {"id": ..., "query": "text of the query"} is answered with {"id": ..., "query": ..., "searched_query": ...,
+        "hits": [...], "search_time": ..., "latency": ..., "batch_size": ...}, where searched_query is the query after OOV mapping,
+        hits the list of the attributes of the kw elements that perform_KWS would write for it, search_time the time spent
+        searching it in the index (as in the search_time attribute written by perform_KWS), latency the time (in seconds) between the reception of the request and its answer
+        and batch_size the number of requests that were searched together with it
+        - {"id": ..., "type": "stats"} is answered with {"id": ..., "stats": get_stats()}
+        The answers of a connection are sent as soon as they are ready (not necessarily in the order of the requests),
+        so that a client can have several requests in flight
+        Its main attributes and methods are:
+        - self.index, self.grapheme_based_mapper and self.level (the level at which the queries are searched, see Index.perform_KWS),
+        along with self.top_k and self.min_score, the pruning options of the searches (see Index.search_scored_hits)
+        - self.batch_window and self.max_batch_size: the requests are queued, and a batch is closed batch_window seconds
+        after its first request arrived, or as soon as it has max_batch_size requests
+        - start(host,port,path_to_socket) starts listening on a TCP port of host (port=0 picks a free one)
+        or on a unix socket if path_to_socket is given, and returns the address it listens on; stop closes the service
+        - submit(query_text) queues a query and returns (asynchronously) its answer, without going through a socket
+        - process_batch(list_of_query_texts) maps the OOV words of a whole batch at once (map_queries_into_proxy_IV_queries)
+        and searches it with a single call to Index.search_hits; the batches are processed one at a time in a worker thread,
+        so that the event loop keeps accepting requests meanwhile and the index and the mapper are never used concurrently
+        - get_stats returns the number of requests and batches served so far, along with percentiles of the latencies
+        of the last self.latency_window requests
+        """
+        def __init__(self,index,grapheme_based_mapper=None,level="word",batch_window=0.005,max_batch_size=256,latency_window=10000,top_k=None,min_score=None):
+                self.index = index
+                self.grapheme_based_mapper = grapheme_based_mapper
+                self.level = level
+                self.batch_window = batch_window
+                self.max_batch_size = max_batch_size
+                self.latency_window = latency_window
+                self.top_k = top_k
+                self.min_score = min_score
+                self.latencies = deque(maxlen=latency_window)
+                self.batch_sizes = deque(maxlen=latency_window)
+                self.n_requests = 0
+                self.n_batches = 0
+                self.queue = None
+                self.server = None
+                self.batcher = None
+                self.executor = None
+
+        async def start(self,host="127.0.0.1",port=0,path_to_socket=None):
+                self.queue = asyncio.Queue()
+                self.executor = ThreadPoolExecutor(max_workers=1)
+                self.batcher = asyncio.ensure_future(self.run_batches())
+                if path_to_socket is not None:
+                        self.server = await asyncio.start_unix_server(self.handle_connection,path=path_to_socket,limit=LINE_LIMIT)
+                        return path_to_socket
+                self.server = await asyncio.start_server(self.handle_connection,host,port,limit=LINE_LIMIT)
+                return self.server.sockets[0].getsockname()[:2]
+
+        async def stop(self):
+                if self.server is not None:
+                        self.server.close()
+                        await self.server.wait_closed()
+                        self.server = None
+                if self.batcher is not None:
+                        self.batcher.cancel()
+                        try:
+                                await self.batcher
+                        except asyncio.CancelledError:
+                                pass
+                        self.batcher = None
+                if self.executor is not None:
+                        self.executor.shutdown()
+                        self.executor = None
+
+        async def submit(self,query_text):
+                future = asyncio.get_running_loop().create_future()
+                await self.queue.put((query_text,future,time.perf_counter()))
+                return await future
+
+        async def run_batches(self):
+                loop = asyncio.get_running_loop()
+                while True:
+                        batch = [await self.queue.get()]
+                        deadline = loop.time() + self.batch_window
+                        while len(batch) < self.max_batch_size:
+                                timeout = deadline - loop.time()
+                                if timeout <= 0:
+                                        break
+                                try:
+                                        batch.append(await asyncio.wait_for(self.queue.get(),timeout))
+                                except asyncio.TimeoutError:
+                                        break
+                        list_of_query_texts = [query_text for query_text, future, arrival_time in batch]
+                        try:
+                                results = await loop.run_in_executor(self.executor,self.process_batch,list_of_query_texts)
+                        except Exception as exception:
+                                for query_text, future, arrival_time in batch:
+                                        if not future.done():
+                                                future.set_exception(exception)
+                                continue
+                        self.n_batches += 1
+                        self.batch_sizes.append(len(batch))
+                        for (query_text, future, arrival_time), (searched_query, list_of_hit_attributes, search_time) in zip(batch,results):
+                                latency = time.perf_counter() - arrival_time
+                                self.n_requests += 1
+                                self.latencies.append(latency)
+                                if not future.done():
+                                        future.set_result(dict([("query",query_text),("searched_query",searched_query),("hits",list_of_hit_attributes),("search_time",search_time),("latency",latency),("batch_size",len(batch))]))
+
+        def process_batch(self,list_of_query_texts):
+                # (searched query, attributes of the hits, search time) for each query of the batch
+                list_of_query_words = [query_text.split() for query_text in list_of_query_texts]
+                if self.grapheme_based_mapper is not None:
+                        list_of_query_words = self.grapheme_based_mapper.map_queries_into_proxy_IV_queries(list_of_query_words)
+                searched_queries = [" ".join(query_words) for query_words in list_of_query_words]
+                list_of_query_tokens = [self.index.get_query_tokens(searched_query,self.level) for searched_query in searched_queries]
+                query_times = np.zeros(len(list_of_query_tokens))
+                list_of_hits = self.index.search_hits(list_of_query_tokens,self.level,self.top_k,self.min_score,query_times)
+                return [(searched_query, [dict(hit_attributes) for hit_attributes in hits], float(query_time)) for searched_query, hits, query_time in zip(searched_queries,list_of_hits,query_times)]
+
+        async def handle_connection(self,reader,writer):
+                pending = set()
+                try:
+                        while True:
+                                line = await reader.readline()
+                                if not line:
+                                        break
+                                if not line.strip():
+                                        continue
+                                task = asyncio.ensure_future(self.answer(line,writer))
+                                pending.add(task)
+                                task.add_done_callback(pending.discard)
+                        if pending:
+                                await asyncio.gather(*pending)
+                finally:
+                        writer.close()
+
+        async def answer(self,line,writer):
+                request_id = None
+                try:
+                        request = json.loads(line)
+                        request_id = request.get("id")
+                        if request.get("type") == "stats":
+                                response = dict([("id",request_id),("stats",self.get_stats())])
+                        else:
+                                response = dict([("id",request_id)])
+                                response.update(await self.submit(request["query"]))
+                except Exception as exception:
+                        response = dict([("id",request_id),("error",repr(exception))])
+                writer.write((json.dumps(response)+"\n").encode("utf-8"))
+                try:
+                        await writer.drain()
+                except ConnectionError:
+                        pass
+
+        def get_stats(self):
+                stats = dict([("n_requests",self.n_requests),("n_batches",self.n_batches)])
+                if len(self.latencies) != 0:
+                        latencies = np.array(self.latencies)
+                        stats["mean_batch_size"] = float(np.mean(self.batch_sizes))
+                        stats["mean_latency"] = float(np.mean(latencies))
+                        for percentile in [50,90,99]:
+                                stats["p%d_latency" % percentile] = float(np.percentile(latencies,percentile))
+                        stats["max_latency"] = float(np.max(latencies))
+                return stats
+
+
+class KWS_Client():
+        """
+        Client of a KWS_Service, over a single connection on which several requests can be in flight
+        - connect(host,port,path_to_socket) opens the connection (to a unix socket if path_to_socket is given), and close closes it
+        - search(query_text) sends a query and returns (asynchronously) the answer of the service;
+        search_many sends a list of queries at once, and get_stats asks for the statistics of the service
+        The answers are matched to the requests by their "id" field, assigned by the client
+        """
+        def __init__(self):
+                self.reader = None
+                self.writer = None
+                self.next_id = 0
+                self.pending = dict()
+                self.receiver = None
+
+        async def connect(self,host="127.0.0.1",port=None,path_to_socket=None):
+                if path_to_socket is not None:
+                        self.reader, self.writer = await asyncio.open_unix_connection(path_to_socket,limit=LINE_LIMIT)
+                else:
+                        self.reader, self.writer = await asyncio.open_connection(host,port,limit=LINE_LIMIT)
+                self.receiver = asyncio.ensure_future(self.receive())
+                return self
+
+        async def close(self):
+                if self.writer is not None:
+                        self.writer.close()
+                        await self.writer.wait_closed()
+                        self.writer = None
+                if self.receiver is not None:
+                        self.receiver.cancel()
+                        try:
+                                await self.receiver
+                        except asyncio.CancelledError:
+                                pass
+                        self.receiver = None
+
+        async def receive(self):
+                try:
+                        while True:
+                                line = await self.reader.readline()
+                                if not line:
+                                        break
+                                response = json.loads(line)
+                                future = self.pending.pop(response.get("id"),None)
+                                if future is not None and not future.done():
+                                        future.set_result(response)
+                finally:
+                        for future in self.pending.values():
+                                if not future.done():
+                                        future.set_exception(ConnectionError("connection to the KWS service closed"))
+                        self.pending.clear()
+
+        async def send(self,request):
+                request_id = self.next_id
+                self.next_id += 1
+                request["id"] = request_id
+                future = asyncio.get_running_loop().create_future()
+                self.pending[request_id] = future
+                self.writer.write((json.dumps(request)+"\n").encode("utf-8"))
+                await self.writer.drain()
+                return await future
+
+        async def search(self,query_text):
+                return await self.send(dict([("query",query_text)]))
+
+        async def search_many(self,list_of_query_texts):
+                return await asyncio.gather(*[self.search(query_text) for query_text in list_of_query_texts])
+
+        async def get_stats(self):
+                return (await self.send(dict([("type","stats")])))["stats"]
+
+
+async def run_load_test(list_of_query_texts,n_clients=8,n_requests=1000,host="127.0.0.1",port=None,path_to_socket=None):
+        """
+        Stands in for real callers of a running KWS_Service: n_clients clients send n_requests queries in total
+        (cycling through list_of_query_texts), each client keeping all its requests in flight
+        Returns the answers (in the order of the requests) and a summary with the throughput and the latencies
+        measured by the clients (including the socket round trip) and by the service
+        (mean_request_batch_size is the size of the batch of the average request, which weighs large batches more than the service statistics)
+        """
+        clients = [await KWS_Client().connect(host,port,path_to_socket) for client_index in range(n_clients)]
+        start_time = time.perf_counter()
+
+        async def timed_search(client,query_text):
+                request_start_time = time.perf_counter()
+                answer = await client.search(query_text)
+                client_latencies.append(time.perf_counter() - request_start_time)
+                return answer
+
+        client_latencies = []
+        answers = await asyncio.gather(*[timed_search(clients[request_index % n_clients],list_of_query_texts[request_index % len(list_of_query_texts)]) for request_index in range(n_requests)])
+        elapsed_time = time.perf_counter() - start_time
+        summary = dict([("n_requests",n_requests),("n_clients",n_clients),("elapsed_time",elapsed_time),("throughput",n_requests/elapsed_time)])
+        if n_requests != 0:
+                summary["mean_request_batch_size"] = float(np.mean([answer["batch_size"] for answer in answers]))
+                for percentile in [50,90,99]:
+                        summary["p%d_client_latency" % percentile] = float(np.percentile(client_latencies,percentile))
+        summary["service_stats"] = await clients[0].get_stats()
+        for client in clients:
+                await client.close()
+        return answers, summary
+
+
+def run_service(index,grapheme_based_mapper=None,level="word",host="127.0.0.1",port=8765,path_to_socket=None,batch_window=0.005,max_batch_size=256,top_k=None,min_score=None):
+        """
+        Runs a KWS_Service until the process is interrupted
+        """
+        async def serve():
+                service = KWS_Service(index,grapheme_based_mapper,level,batch_window,max_batch_size,top_k=top_k,min_score=min_score)
+                address = await service.start(host,port,path_to_socket)
+                print("KWS service listening on", address)
+                try:
+                        await asyncio.Event().wait()
+                finally:
+                        await service.stop()
+        try:
+                asyncio.run(serve())
+        except KeyboardInterrupt:
+                pass
@@ -2,37 +2,128 @@ import xml.etree.ElementTree as ET
 import numpy as np
 from collections import OrderedDict
 from Index import Speech_entity
+from XMLListIO import XML_list_reader, rewrite_XML_list
+from Instrumentation import get_instrumentation
 
 
 
+class Hit_list_arrays():
+        """
+        Parses an XML file that contains a list of KWS hits once (streaming it with XML_list_reader),
+        and stores its scores and durations in flat arrays
+        - self.scores and self.durations are float64 arrays with one entry per hit (in the order of the file)
+        - the hits of the i-th detected_kwlist are the entries self.offsets[i]:self.offsets[i+1] of these arrays
+        - self.path_to_XML_list_of_hits is the path of the file, which is streamed again whenever it is written back
+        with a set of normalized scores
+        """
+        def __init__(self,path_to_XML_list_of_hits):
+                self.path_to_XML_list_of_hits = path_to_XML_list_of_hits
+                scores, durations, lengths = [], [], []
+                for detected_kwlist in XML_list_reader(path_to_XML_list_of_hits):
+                        for kw in detected_kwlist:
+                                scores.append(float(kw.attrib["score"]))
+                                durations.append(float(kw.attrib["dur"]))
+                        lengths.append(len(detected_kwlist))
+                self.scores = np.array(scores,dtype=np.float64)
+                self.durations = np.array(durations,dtype=np.float64)
+                self.offsets = np.concatenate([[0],np.cumsum(lengths)]).astype(np.int64)
+
+
+def normalize_keyword_scores(scores, durations, normalization_method = "STO", alpha = 1, T = 10*60*60, beta = 999.9):
+        """
+        Normalizes the scores of the hits of a single keyword (given as lists of floats, along with their durations)
+        and returns them as the strings written by Normalize_score
+        """
+        if normalization_method == "STO":
+                normalization_factor =  np.sum(np.array(scores)**alpha)+10**(-6)
+                return [str(np.round( score**alpha / normalization_factor , 6)) for score in scores]
+        elif normalization_method == "KST":
+                posterior_sum = np.sum( np.array (scores)  )
+                log_kw_specific_tresh = np.log( beta * alpha * posterior_sum/(T+ (beta - 1)*alpha * posterior_sum) )
+                return [str( np.round( score**(-1/log_kw_specific_tresh) ,6)) for score in scores]
+        elif normalization_method == "QL":
+                average_duration = np.mean( np.array (durations)  ) + 10**(-6)
+                return [str( np.round( score**(1/average_duration) ,6)) for score in scores]
+        else:
+                print("Choose valid normalization method")
+                return None
+
+
+def write_normalized_hit_list(hit_list_arrays,path_to_output_XML_list_of_hits, normalization_method = "STO", alpha = 1, T = 10*60*60, beta = 999.9):
+        """
+        Writes the hit list parsed in hit_list_arrays (a Hit_list_arrays instance) with the scores normalized with the given setting
+        (hit_list_arrays can be written several times with different settings)
+        """
+        write_normalized_XML_list(hit_list_arrays.path_to_XML_list_of_hits,path_to_output_XML_list_of_hits,normalization_method,alpha,T,beta)
+
+
+def write_normalized_XML_list(path_to_input_XML_list_of_hits,path_to_output_XML_list_of_hits, normalization_method = "STO", alpha = 1, T = 10*60*60, beta = 999.9):
+        # each detected_kwlist is normalized and written as soon as it has been read
+        instrumentation = get_instrumentation()
+        def normalize_detected_kwlist(detected_kwlist):
+                instrumentation.increment("normalizer.keywords")
+                instrumentation.increment("normalizer.hits",len(detected_kwlist))
+                if len(detected_kwlist) != 0:
+                        normalized_scores = normalize_keyword_scores([float(kw.attrib["score"]) for kw in detected_kwlist],[float(kw.attrib["dur"]) for kw in detected_kwlist],normalization_method,alpha,T,beta)
+                        if normalized_scores is not None:
+                                for kw, normalized_score in zip(detected_kwlist,normalized_scores):
+                                        kw.attrib["score"] = normalized_score
+        with instrumentation.timer("normalizer.normalization"):
+                rewrite_XML_list(path_to_input_XML_list_of_hits,path_to_output_XML_list_of_hits,normalize_detected_kwlist)
+
+
+def normalize_scores_grid(hit_list_arrays, settings):
+        """
+        Evaluates a whole grid of normalization settings on a hit list parsed once (a Hit_list_arrays instance)
+        settings is a list of (normalization_method, alpha, T, beta) tuples, and the result is an array with one row of
+        normalized scores (rounded as in the XML files) per setting and one column per hit
+        The per-keyword statistics of all the settings of a same method are computed at once with segment reductions,
+        so that the values can differ from the ones of Normalize_score by a rounding error (different summation order and
+        vectorized powers); use write_normalized_hit_list to output the XML file of the chosen setting
+        """
+        scores = hit_list_arrays.scores
+        lengths = np.diff(hit_list_arrays.offsets)
+        non_empty = lengths > 0
+        starts = hit_list_arrays.offsets[:-1][non_empty]
+        # index (among the non empty keywords) of the keyword of each hit
+        keyword_of_hit = np.repeat(np.arange(len(starts)),lengths[non_empty])
+        normalized_scores = np.zeros((len(settings),len(scores)))
+        if len(scores) == 0:
+                return normalized_scores
+        for normalization_method in ["STO","KST","QL"]:
+                setting_indices = [index for index, setting in enumerate(settings) if setting[0] == normalization_method]
+                if len(setting_indices) == 0:
+                        continue
+                alpha, T, beta = [np.array([settings[index][parameter] for index in setting_indices],dtype=np.float64)[:,None] for parameter in [1,2,3]]
+                if normalization_method == "STO":
+                        powered_scores = scores[None,:]**alpha
+                        normalization_factors = np.add.reduceat(powered_scores,starts,axis=1)+10**(-6)
+                        normalized_scores[setting_indices] = powered_scores / normalization_factors[:,keyword_of_hit]
+                elif normalization_method == "KST":
+                        posterior_sums = np.add.reduceat(scores,starts)[None,:]
+                        log_kw_specific_tresh = np.log( beta * alpha * posterior_sums/(T+ (beta - 1)*alpha * posterior_sums) )
+                        normalized_scores[setting_indices] = scores[None,:]**(-1/log_kw_specific_tresh[:,keyword_of_hit])
+                elif normalization_method == "QL":
+                        average_durations = np.add.reduceat(hit_list_arrays.durations,starts)/lengths[non_empty] + 10**(-6)
+                        normalized_scores[setting_indices] = scores[None,:]**(1/average_durations[keyword_of_hit])
+        for index, setting in enumerate(settings):
+                if setting[0] not in ["STO","KST","QL"]:
+                        print("Choose valid normalization method")
+                        normalized_scores[index] = scores
+        return np.round(normalized_scores,6)
+
+
 def Normalize_score(path_to_input_XML_list_of_hits,path_to_output_XML_list_of_hits, normalization_method = "STO", alpha = 1, T = 10*60*60, beta = 999.9):
         """
         Opens an XML file that contains a list of KWS hits, and performs (depending on the normalization_method argument) either
         - "STO": Sum-To-One normalization of the scores (with parameter alpha>0)
         - "KST": Keyword-specific thresholding (with parameter alpha>0, total duration T (in seconds), and weight beta)
         - "QL": Query length normalization
-        Outputs the result in a new XML file
-        """
-        tree=ET.parse(path_to_input_XML_list_of_hits)
-        root = tree.getroot()
-        for detected_kwlist in root:
-                if len(detected_kwlist) != 0: 
-                        if normalization_method == "STO":
-                                scores=np.array([float(kw.attrib["score"]) for kw in detected_kwlist])
-                                normalization_factor =  np.sum(scores**alpha)+10**(-6)
-                                for  kw in detected_kwlist :
-                                        kw.attrib["score"]= str(np.round( float(kw.attrib["score"])**alpha / normalization_factor , 6))
-                        elif normalization_method == "KST":
-                                posterior_sum = np.sum( np.array ([float(kw.attrib["score"]) for kw in detected_kwlist])  )
-                                log_kw_specific_tresh = np.log( beta * alpha * posterior_sum/(T+ (beta - 1)*alpha * posterior_sum) )
-                                for  kw in detected_kwlist :
-                                        kw.attrib["score"]= str( np.round( float(kw.attrib["score"])**(-1/log_kw_specific_tresh) ,6))
-                        elif normalization_method == "QL":
-                                average_duration = np.mean( np.array ([float(kw.attrib["dur"]) for kw in detected_kwlist])  ) + 10**(-6)
-                                for  kw in detected_kwlist :
-                                        kw.attrib["score"]= str( np.round( float(kw.attrib["score"])**(1/average_duration) ,6))
-                        else:
-                                print("Choose valid normalization method")
-        tree.write(path_to_output_XML_list_of_hits)
+        Outputs the result in a new XML file (both files are streamed, so that memory does not grow with the number of hits)
+        To try several settings on the same file, parse it once with Hit_list_arrays, evaluate the settings with normalize_scores_grid
+        and write the chosen one with write_normalized_hit_list
+        The current instrumentation (see Instrumentation) counts the keywords and hits normalized
+        """
+        write_normalized_XML_list(path_to_input_XML_list_of_hits,path_to_output_XML_list_of_hits,normalization_method,alpha,T,beta)
 
 
@@ -1,7 +1,8 @@
 import xml.etree.ElementTree as ET
 import numpy as np
 from collections import OrderedDict
-import copy
+from XMLListIO import XML_list_reader, rewrite_XML_list
+from Instrumentation import get_instrumentation
 
 
 
@@ -12,10 +13,11 @@ class Hit():
         for each of the system that has recognized this hit
         (example: self.scores = {"System1":0.5, "System2":0.6}) 
         - We overload the __eq__ function so that two hits are considered equal
-        if their intervals overlap by more than 30% of the shortest of the two
+        if their intervals overlap by more than 30% of the shortest of the two (self.overlaps)
         - self.combine_hits combine two hits: the resulting hit will have the basic
         characteristics of the hit that contained the highest score in its self.scores,
         and the new self.scores is the union of the self.scores of the two hits
+        (the hits themselves are not modified, and only their dictionaries of scores are copied)
         - self.combined_score takes as argument a dictionary that specifies the 
         MTWV of each of the system for which it has a score in self.scores, 
         and computes the combined score out of self.scores using the methodology 
@@ -30,19 +32,25 @@ class Hit():
                 self.scores = scores
 
         def __eq__(self,other_Hit):
-                i = [self.tbeg,other_Hit.tbeg].index( min([self.tbeg,other_Hit.tbeg]) )
-                intersection = max(0,[self.tbeg+self.tdur,other_Hit.tbeg+other_Hit.tdur][i]-[self.tbeg,other_Hit.tbeg][1-i])
-                return (intersection>0.3*min(self.tdur,other_Hit.tdur) and self.channel_name == other_Hit.channel_name and self.file_name == other_Hit.file_name)
+                return (self.overlaps(other_Hit) and self.channel_name == other_Hit.channel_name and self.file_name == other_Hit.file_name)
         
         def __hash__(self):
                 return hash((self.file_name,self.channel_name))
+
+        def overlaps(self,other_Hit):
+                i = [self.tbeg,other_Hit.tbeg].index( min([self.tbeg,other_Hit.tbeg]) )
+                intersection = max(0,[self.tbeg+self.tdur,other_Hit.tbeg+other_Hit.tdur][i]-[self.tbeg,other_Hit.tbeg][1-i])
+                return intersection>0.3*min(self.tdur,other_Hit.tdur)
+
+        def copy(self):
+                return Hit([self.file_name,self.channel_name,self.tbeg,self.tdur],dict(self.scores))
         
         def combine_hits(self, other_Hit):
                 if max(self.scores.values())>= max(other_Hit.scores.values()):
-                        combined_hit = copy.deepcopy(self)
+                        combined_hit = self.copy()
                         combined_hit.scores.update(other_Hit.scores)
                 else:
-                        combined_hit = copy.deepcopy(other_Hit)
+                        combined_hit = other_Hit.copy()
                         combined_hit.scores.update(self.scores)
                 return combined_hit
 
@@ -85,9 +93,18 @@ class System_Combiner():
         - the methodology with which to merge the scores
 
         The hits are stored as instances of the class Hit
+        The first XML list of hits is streamed (see XMLListIO) and each of its detected_kwlist is written, with the merged hits,
+        as soon as it has been read; the hits of the other systems are accessed by kwid through Kwid_hits_cursor instances,
+        which stream the other files along (so that memory does not grow with the number of hits when all the files list the
+        keywords in the same order)
         For each query, it uses self.merge_list_of_hits to create a single list
         out of all the hits associated to that query (from all systems),
-        and merge the hits when necessary using the methods from the Hit class
+        and merge the hits when necessary:
+        the hits of each (file, channel) are swept in increasing order of beginning time, and each hit joins the first
+        cluster whose first hit it overlaps (by more than 30% of the shortest of the two, see Hit.overlaps), or starts a new one
+        Each cluster becomes a single hit with the characteristics of its hit of highest score and, for each system,
+        the highest score of that system in the cluster; the result does not depend on the order of the hits in the input
+        The current instrumentation (see Instrumentation) counts the hits read and the hits merged into another one
         """
         def __init__(self):
                 self.systems = []
@@ -96,35 +113,86 @@ class System_Combiner():
         def merge_XML_lists_of_hits_files(self,list_of_paths_to_XML_files,path_to_output_merged_XML_file, list_of_systems_names,dict_of_systems_MTWV,combination_methodology):
                 self.systems = list_of_systems_names
                 self.systems_MTWV = dict_of_systems_MTWV
-                new_tree = copy.deepcopy(ET.parse(list_of_paths_to_XML_files[0]))
-                new_root = new_tree.getroot()
-                root_dict = dict()
-                for index, system_name in enumerate(self.systems):
-                        root_dict[system_name] = ET.parse(list_of_paths_to_XML_files[index]).getroot()
-                for detected_kwlist in new_root:
+                cursors = [Kwid_hits_cursor(path_to_XML_file,system_name) for path_to_XML_file, system_name in zip(list_of_paths_to_XML_files[1:],self.systems[1:])]
+                def merge_detected_kwlist(detected_kwlist):
+                        kwid = detected_kwlist.attrib["kwid"]
+                        list_of_hits = read_hits(detected_kwlist,self.systems[0])
                         for kw in list(detected_kwlist):
                                 detected_kwlist.remove(kw)
-                        kwid = detected_kwlist.attrib["kwid"]
-                        list_of_hits = []
-                        for system, root in root_dict.items():
-                                for query in root:
-                                        if query.attrib["kwid"] == kwid:
-                                                for kw in query:
-                                                        info=[kw.attrib["file"],kw.attrib["channel"], kw.attrib["tbeg"],kw.attrib["dur"]]                                                 
-                                                        list_of_hits.append(Hit(info,{system: float(kw.attrib["score"])}))
+                        for cursor in cursors:
+                                list_of_hits.extend(cursor.get_hits(kwid))
                         merged_list_of_hits = self.merge_list_of_hits(list_of_hits)
                         for hit in merged_list_of_hits:
                                 detected_kwlist.append(hit.get_kw_element(self.systems_MTWV,combination_methodology))
-                new_tree.write(path_to_output_merged_XML_file)
+                with get_instrumentation().timer("combiner.combination"):
+                        rewrite_XML_list(list_of_paths_to_XML_files[0],path_to_output_merged_XML_file,merge_detected_kwlist)
         
         def merge_list_of_hits(self,list_of_hits):
-                merged_list = dict()
+                hits_by_recording = dict()
                 for hit in list_of_hits:
-                        # We use the overloaded __eq__ function of the Hit class
-                        if hit in merged_list:
-                                merged_list[hit] = hit.combine_hits(merged_list[hit])
-                        else:
-                                merged_list[hit] = hit
-                return [merged_list[hit] for hit in merged_list]
+                        hits_by_recording.setdefault((hit.file_name,hit.channel_name),[]).append(hit)
+                merged_list = []
+                for recording in sorted(hits_by_recording):
+                        # the order of the hits only depends on their content
+                        sorted_hits = sorted(hits_by_recording[recording],key=lambda hit: (hit.tbeg,hit.tdur,sorted(hit.scores.items())))
+                        clusters = []
+                        active_clusters = []
+                        for hit in sorted_hits:
+                                # clusters whose first hit ends before hit begins can not overlap hit or any of the following hits
+                                active_clusters = [cluster for cluster in active_clusters if cluster[0].tbeg + cluster[0].tdur > hit.tbeg or cluster[0].tbeg == hit.tbeg]
+                                for cluster in active_clusters:
+                                        if hit.overlaps(cluster[0]):
+                                                cluster.append(hit)
+                                                break
+                                else:
+                                        clusters.append([hit])
+                                        active_clusters.append(clusters[-1])
+                        for cluster in clusters:
+                                merged_list.append(self.combine_cluster(cluster))
+                instrumentation = get_instrumentation()
+                instrumentation.increment("combiner.hits_read",len(list_of_hits))
+                instrumentation.increment("combiner.hits_merged",len(list_of_hits) - len(merged_list))
+                return merged_list
+
+        def combine_cluster(self,cluster):
+                best_hit = cluster[0]
+                scores = dict()
+                for hit in cluster:
+                        if max(hit.scores.values()) > max(best_hit.scores.values()):
+                                best_hit = hit
+                        for system_name, score in hit.scores.items():
+                                scores[system_name] = max(score,scores.get(system_name,score))
+                return Hit([best_hit.file_name,best_hit.channel_name,best_hit.tbeg,best_hit.tdur],scores)
+
         
-        
\ No newline at end of file
+
+
+def read_hits(detected_kwlist,system_name):
+        list_of_hits = []
+        for kw in detected_kwlist:
+                info=[kw.attrib["file"],kw.attrib["channel"], kw.attrib["tbeg"],kw.attrib["dur"]]
+                list_of_hits.append(Hit(info,{system_name: float(kw.attrib["score"])}))
+        return list_of_hits
+
+
+class Kwid_hits_cursor():
+        """
+        Gives access, kwid by kwid, to the hits of an XML list of hits of a system, streaming the file
+        get_hits(kwid) reads the file until the detected_kwlist of kwid (the hits of the detected_kwlists read on the way
+        are kept in self.pending_hits, as Hit instances, until they are requested), so that only one detected_kwlist
+        is kept in memory when the kwids are requested in the order of the file
+        """
+        def __init__(self,path_to_XML_file,system_name):
+                self.system_name = system_name
+                self.detected_kwlists = iter(XML_list_reader(path_to_XML_file))
+                self.pending_hits = dict()
+
+        def get_hits(self,kwid):
+                if kwid in self.pending_hits:
+                        return self.pending_hits.pop(kwid)
+                for detected_kwlist in self.detected_kwlists:
+                        list_of_hits = read_hits(detected_kwlist,self.system_name)
+                        if detected_kwlist.attrib["kwid"] == kwid:
+                                return list_of_hits
+                        self.pending_hits.setdefault(detected_kwlist.attrib["kwid"],[]).extend(list_of_hits)
+                return []
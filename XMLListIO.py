@@ -0,0 +1,105 @@
+import xml.etree.ElementTree as ET
+
+
+class XML_list_reader():
+        """
+        Reads an XML list (a kwlist of queries, or a kwslist of hits) incrementally
+        Iterating over the reader yields the children of the root element (kw or detected_kwlist elements) one at a time,
+        each complete with its own children and tail; a child is removed from the root as soon as the next one is requested,
+        so that only one of them is kept in memory however long the file is
+        self.root is the root element (with its tag, attributes and text, but without children),
+        and is available as soon as the first child has been yielded
+        """
+        def __init__(self,path_to_XML_file):
+                self.path_to_XML_file = path_to_XML_file
+                self.root = None
+
+        def __iter__(self):
+                depth = 0
+                pending_child = None
+                for event, element in ET.iterparse(self.path_to_XML_file,events=("start","end")):
+                        if event == "start":
+                                if depth == 0:
+                                        self.root = element
+                                elif depth == 1 and pending_child is not None:
+                                        # the tail of pending_child is only known once the next child starts
+                                        yield pending_child
+                                        self.root.remove(pending_child)
+                                        pending_child = None
+                                depth += 1
+                        else:
+                                depth -= 1
+                                if depth == 1:
+                                        pending_child = element
+                if pending_child is not None:
+                        yield pending_child
+                        self.root.remove(pending_child)
+
+
+class XML_list_writer():
+        """
+        Writes an XML list one child of the root at a time, with the same bytes as ElementTree.write would produce
+        for the whole tree (with the default us-ascii encoding and no XML declaration)
+        The root element is given by its tag, attributes and text when the writer is created, write_child writes
+        a complete child (with its tail) as soon as it is done, and close writes the end of the root element
+        write_child can also be given the bytes of further children of the child, already serialized (with their tails),
+        which are written after its own children
+        The writer can be used as a context manager
+        """
+        def __init__(self,path_to_XML_file,root_tag,root_attrib,root_text=None):
+                self.file = open(path_to_XML_file,"wb")
+                self.root = ET.Element(root_tag,root_attrib)
+                self.root.text = root_text
+                self.n_children = 0
+
+        def __enter__(self):
+                return self
+
+        def __exit__(self,exception_type,exception,traceback):
+                self.close()
+
+        def write_child(self,child,serialized_children=b""):
+                if self.n_children == 0:
+                        self.file.write(serialize_around_placeholder(self.root)[0])
+                if len(serialized_children) == 0:
+                        self.file.write(ET.tostring(child,encoding="us-ascii"))
+                else:
+                        start, end = serialize_around_placeholder(child)
+                        self.file.write(start)
+                        self.file.write(serialized_children)
+                        self.file.write(end)
+                self.n_children += 1
+
+        def close(self):
+                if self.file.closed:
+                        return
+                if self.n_children == 0:
+                        self.file.write(ET.tostring(self.root,encoding="us-ascii"))
+                else:
+                        self.file.write(("</%s>" % self.root.tag).encode("us-ascii"))
+                self.file.close()
+
+
+def serialize_around_placeholder(element):
+        # the bytes of element before and after a last child, serialized with a placeholder child so that the escaping is the one of ElementTree
+        placeholder = ET.SubElement(element,"placeholder")
+        start, end = ET.tostring(element,encoding="us-ascii").split(b"<placeholder />")
+        element.remove(placeholder)
+        return start, end
+
+
+def rewrite_XML_list(path_to_XML_input,path_to_XML_output,rewrite_child):
+        """
+        Streams an XML list into a new file with the same root element, after applying rewrite_child
+        (a function that modifies a child of the root in place) to each child of the root
+        """
+        reader = XML_list_reader(path_to_XML_input)
+        writer = None
+        for child in reader:
+                if writer is None:
+                        writer = XML_list_writer(path_to_XML_output,reader.root.tag,reader.root.attrib,reader.root.text)
+                rewrite_child(child)
+                writer.write_child(child)
+        if writer is None:
+                writer = XML_list_writer(path_to_XML_output,reader.root.tag,reader.root.attrib,reader.root.text)
+        writer.close()